@@ -0,0 +1,163 @@
+# Local HTTP stand-in for wenku8 serving the recorded fixture pages with configurable latency
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os
+import threading
+import time
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Smallest valid JPEG header plus padding, the pipeline never decodes it unless downscaling is on
+FAKE_JPEG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00' + b'\x00' * 20000 + b'\xff\xd9'
+
+
+def read_fixture(name):
+    """
+    Text of a fixture page
+
+    @type name: str
+    @param name: file name inside benchmarks/fixtures
+    """
+
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8-sig') as f:
+        return f.read()
+
+
+def make_index(volumes, chapters_per_volume, illustrations=True):
+    """
+    Build an index page with the same table layout as wenku8: a 'vcss' cell per volume heading,
+    'ccss' cells holding chapter links and '&nbsp;' filler cells completing each row of four
+
+    @type volumes: int
+    @param volumes: number of volumes
+    @type chapters_per_volume: int
+    @param chapters_per_volume: number of chapters in each volume, not counting '插图'
+    @type illustrations: bool
+    @param illustrations: end every volume with a '插图' chapter
+    """
+
+    numerals = '一二三四五六七八九十'
+    rows = []
+    chapter_id = 1000
+
+    for v in range(volumes):
+        name = '第%s卷' % (numerals[v] if v < len(numerals) else str(v + 1))
+        rows.append('<tr><td class="vcss" colspan="4">%s 测试卷名</td></tr>' % name)
+
+        titles = ['第%d章 测试章节' % (c + 1) for c in range(chapters_per_volume)]
+        if illustrations:
+            titles.append('插图')
+
+        cells = []
+        for title in titles:
+            chapter_id += 1
+            cells.append('<td class="ccss"><a href="%d.htm">%s</a></td>' % (chapter_id, title))
+        while len(cells) % 4:
+            cells.append('<td class="ccss">&nbsp;</td>')
+
+        for i in range(0, len(cells), 4):
+            rows.append('<tr>' + ''.join(cells[i:i + 4]) + '</tr>')
+
+    return ('<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8" />'
+            '<title>测试小说</title></head><body>'
+            '<div id="title">测试小说(测试)</div><div id="info">作者：测试作者</div>'
+            '<table class="css" border="0" align="center" cellpadding="3" cellspacing="1">'
+            + '\n'.join(rows) +
+            '</table></body></html>')
+
+
+class MockServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 makes bursts of concurrent connections wait for SYN retries
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MockSite:
+    """
+    Threaded HTTP server answering index, chapter and image requests from the fixtures
+
+    @type volumes: int
+    @param volumes: number of volumes listed on the index page
+    @type chapters_per_volume: int
+    @param chapters_per_volume: number of text chapters per volume
+    @type latency: float
+    @param latency: seconds every response is delayed by
+    """
+
+    def __init__(self, volumes=2, chapters_per_volume=10, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.index_page = make_index(volumes, chapters_per_volume).encode('utf-8')
+        self.illustration_ids = set()
+        self._chapter = read_fixture('chapter.html').encode('utf-8')
+        self._illustrations = read_fixture('illustrations.html')
+        self._lock = threading.Lock()
+
+        # Remember which ids are '插图' chapters so they get the illustration page
+        chapter_id = 1000
+        for _ in range(volumes):
+            chapter_id += chapters_per_volume + 1
+            self.illustration_ids.add(str(chapter_id))
+
+        self.server = MockServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    @property
+    def index_url(self):
+        return self.base_url + '/novel/1/1/index.htm'
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with site._lock:
+                    site.requests += 1
+                time.sleep(site.latency)
+
+                path = self.path.split('?')[0]
+                if path.endswith('/index.htm'):
+                    self._send(site.index_page, 'text/html; charset=utf-8')
+                elif path.startswith('/pic/'):
+                    self._send(FAKE_JPEG, 'image/jpeg')
+                elif path.endswith('.htm'):
+                    chapter_id = path.rsplit('/', 1)[-1].split('.')[0]
+                    if chapter_id in site.illustration_ids:
+                        page = site._illustrations.replace('{image_base}', site.base_url + '/pic/' + chapter_id)
+                        self._send(page.encode('utf-8'), 'text/html; charset=utf-8')
+                    else:
+                        self._send(site._chapter, 'text/html; charset=utf-8')
+                else:
+                    self.send_error(404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg' if self.path.startswith('/pic/') else 'text/html')
+                self.end_headers()
+
+            def _send(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,64 @@
+# Compares the HTML parser backends used by clean_chapter on downloaded chapter pages
+# Version: 1
+# Date: 17/ 10/ 2026
+#
+# Usage: python parser_backends.py chapter.html [chapter.html ...] [--repeat N]
+
+# Import dependencies
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import functions  # noqa: E402
+
+
+def available_backends():
+    """
+    (name, parser, targeted) of every backend that can run here, the first one is the old behaviour
+    """
+
+    backends = [("html.parser full page", "html.parser", False),
+                ("html.parser #content only", "html.parser", True)]
+
+    if functions.HTML_PARSER == 'lxml':
+        backends += [("lxml full page", "lxml", False),
+                     ("lxml #content only", "lxml", True)]
+    else:
+        print("parser_backends: lxml is not installed, skipping lxml backends")
+
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-chapter parse time of each HTML parser backend")
+    parser.add_argument("chapters", nargs="+", help="downloaded chapter html files")
+    parser.add_argument("--repeat", type=int, default=20, help="parses per chapter and backend")
+    args = parser.parse_args()
+
+    pages = []
+    for chapter_file in args.chapters:
+        with open(chapter_file, 'r', encoding='utf-8-sig') as f:
+            pages.append(f.read())
+
+    backends = available_backends()
+    reference = [functions.chapter_text(page, backends[0][1], backends[0][2]) for page in pages]
+
+    for name, html_parser, targeted in backends:
+        # Every backend must give exactly the same text as the old one
+        texts = [functions.chapter_text(page, html_parser, targeted) for page in pages]
+        same = "same text" if texts == reference else "TEXT DIFFERS"
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for page in pages:
+                functions.chapter_text(page, html_parser, targeted)
+        elapsed = time.perf_counter() - start
+
+        per_chapter = elapsed / (args.repeat * len(pages)) * 1000
+        print("%-28s %8.2f ms/chapter  (%s)" % (name, per_chapter, same))
+
+
+if __name__ == "__main__":
+    main()
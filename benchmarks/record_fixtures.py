@@ -0,0 +1,52 @@
+# Records real wenku8 pages as benchmark fixtures, replacing the bundled sample pages
+# Version: 1
+# Date: 17/ 10/ 2026
+#
+# Usage: python record_fixtures.py INDEX_URL CHAPTER_URL ILLUSTRATION_URL
+
+# Import dependencies
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import functions  # noqa: E402
+from mock_site import FIXTURE_DIR  # noqa: E402
+
+
+def main():
+    if len(sys.argv) != 4:
+        print("Usage: python record_fixtures.py INDEX_URL CHAPTER_URL ILLUSTRATION_URL")
+        sys.exit(1)
+
+    index_url, chapter_url, illustration_url = sys.argv[1:]
+
+    try:
+        functions.download_html(index_url, os.path.join(FIXTURE_DIR, 'index.html'),
+                                ready_selector=functions.INDEX_READY)
+        functions.download_html(chapter_url, os.path.join(FIXTURE_DIR, 'chapter.html'))
+
+        illustration_file = os.path.join(FIXTURE_DIR, 'illustrations.html')
+        functions.download_html(illustration_url, illustration_file, page_type='illustrations')
+    finally:
+        functions.close_browser_pool()
+
+    # Point the images at the mock site instead of the real image host
+    with open(illustration_file, 'r', encoding='utf-8-sig') as f:
+        page = f.read()
+
+    count = [0]
+
+    def local_image(match):
+        count[0] += 1
+        return 'src="{image_base}/%d.jpg"' % count[0]
+
+    page = re.sub(r'src="[^"]+\.(?:jpg|jpeg|png)"', local_image, page)
+    with open(illustration_file, 'w', encoding='utf-8-sig') as f:
+        f.write(page)
+
+    print("record_fixtures: Recorded fixtures in %s" % FIXTURE_DIR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# Offline benchmark suite: microbenchmarks of the parsing and packing functions plus end-to-end
+# conversions against the local mock site, results are written as JSON
+# Version: 1
+# Date: 17/ 10/ 2026
+#
+# Usage: python run_benchmarks.py [--repeat N] [--latency 0 0.05 ...] [--async-fetch] [--output results.json]
+
+# Import dependencies
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import functions  # noqa: E402
+import main  # noqa: E402
+from http_cache import HttpCache  # noqa: E402
+from chapter_store import ChapterStore  # noqa: E402
+from mock_site import MockSite, FIXTURE_DIR, make_index  # noqa: E402
+
+
+def measure(name, func, repeat, setup=None):
+    """
+    Time func over repeat runs, setup runs before each call and is not timed
+
+    @type name: str
+    @param name: benchmark name in the results
+    @type func: function
+    @param func: code being measured
+    @type repeat: int
+    @param repeat: number of timed runs
+    @type setup: function
+    @param setup: preparation run before each call
+    """
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        # Keep the progress messages of the functions out of the measurement output
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    result = {
+        'name': name,
+        'repeat': repeat,
+        'mean_ms': sum(times) / len(times) * 1000,
+        'min_ms': min(times) * 1000,
+        'max_ms': max(times) * 1000,
+    }
+    print("%-36s mean %9.3f ms   min %9.3f ms" % (name, result['mean_ms'], result['min_ms']))
+    return result
+
+
+def microbenchmarks(workspace, repeat):
+    """
+    Benchmark extract_index, clean_chapter, extract_images, create_epub and compress_epub on the fixtures
+
+    @type workspace: str
+    @param workspace: scratch folder, the current directory is its 'src' subfolder
+    @type repeat: int
+    @param repeat: number of timed runs per benchmark
+    """
+
+    results = []
+    index_url = 'http://127.0.0.1/novel/1/1/index.htm'
+
+    # Index pages: small, large and a recorded one if record_fixtures.py has been run
+    index_pages = [('small', make_index(2, 10)), ('large', make_index(20, 150))]
+    recorded_index = os.path.join(FIXTURE_DIR, 'index.html')
+    if os.path.exists(recorded_index):
+        with open(recorded_index, 'r', encoding='utf-8-sig') as f:
+            index_pages.append(('recorded', f.read()))
+
+    for label, page in index_pages:
+        index_file = os.path.join(workspace, 'index_%s.html' % label)
+        with open(index_file, 'w', encoding='utf-8-sig') as f:
+            f.write(page)
+        results.append(measure('extract_index (%s)' % label,
+                               lambda: functions.extract_index(index_url, index_file, 'all'), repeat))
+
+    # clean_chapter rewrites the file in place, so start from the fixture every time
+    chapter_file = os.path.join(workspace, 'chapter.html')
+    results.append(measure('clean_chapter',
+                           lambda: functions.clean_chapter(chapter_file, '第一章 序幕'), repeat,
+                           setup=lambda: shutil.copyfile(os.path.join(FIXTURE_DIR, 'chapter.html'), chapter_file)))
+
+    image_page = os.path.join(FIXTURE_DIR, 'illustrations.html')
+    results.append(measure('extract_images',
+                           lambda: functions.extract_images(image_page, delete=False), repeat))
+
+    # A cleaned volume of 30 chapters for the packing benchmarks
+    volume_dir = os.path.join(workspace, 'volume')
+    os.makedirs(volume_dir, exist_ok=True)
+    chapter_list = []
+    for i in range(30):
+        chapter_file = os.path.join(volume_dir, '%d.html' % i)
+        shutil.copyfile(os.path.join(FIXTURE_DIR, 'chapter.html'), chapter_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            functions.clean_chapter(chapter_file, '第%d章' % (i + 1))
+        chapter_list.append(('第%d章' % (i + 1), chapter_file))
+    cover_file = os.path.join(volume_dir, 'cover.jpg')
+    with open(cover_file, 'wb') as f:
+        f.write(b'\xff\xd8' + b'\x00' * 100000 + b'\xff\xd9')
+
+    # Without the build cache every run would be skipped after the first one
+    build_cache_dir = functions.build_cache_dir
+    functions.build_cache_dir = None
+    results.append(measure('create_epub (30 chapters)',
+                           lambda: functions.create_epub('bench_create', '测试作者', chapter_list, cover_file),
+                           repeat))
+
+    # Unchanged volume: only hashing the parts, the epub is not written again
+    functions.build_cache_dir = os.path.join(workspace, 'builds')
+    with contextlib.redirect_stdout(io.StringIO()):
+        functions.create_epub('bench_cached', '测试作者', chapter_list, cover_file)
+    results.append(measure('create_epub (30 chapters, unchanged)',
+                           lambda: functions.create_epub('bench_cached', '测试作者', chapter_list, cover_file),
+                           repeat))
+    functions.build_cache_dir = build_cache_dir
+
+    parts = [("mimetype", b"application/epub+zip")]
+    for i, (_, chapter_file) in enumerate(chapter_list):
+        with open(chapter_file, 'rb') as f:
+            parts.append(("OEBPS/chapter_%d.xhtml" % (i + 1), f.read()))
+    results.append(measure('compress_epub (30 chapters)',
+                           lambda: functions.compress_epub('bench_compress', parts), repeat))
+
+    return results
+
+
+def end_to_end(workspace, latency, volumes, chapters):
+    """
+    Convert every volume of the mock book twice: once with an empty cache, once with a warm one
+
+    @type workspace: str
+    @param workspace: scratch folder, the current directory is its 'src' subfolder
+    @type latency: float
+    @param latency: seconds the mock site delays every response by
+    @type volumes: int
+    @param volumes: number of volumes of the mock book
+    @type chapters: int
+    @param chapters: number of text chapters per volume
+    """
+
+    site = MockSite(volumes, chapters, latency).start()
+    result = {'latency_s': latency, 'volumes': volumes, 'chapters_per_volume': chapters}
+
+    # The mock site has no Cloudflare check, use the plain HTTP tier from the first request
+    functions.use_http_fetch = True
+    functions.clearance_ready = True
+    functions.http_cache = HttpCache(os.path.join(workspace, 'cache_%s' % latency))
+    functions.chapter_store = ChapterStore(os.path.join(workspace, 'store_%s' % latency, 'chapters.sqlite3'))
+    result['async_fetch'] = functions.async_fetcher() is not None
+
+    try:
+        for run in ('cold', 'warm'):
+            requests_before = site.requests
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                main.convert_book(site.index_url, 'all', 'first')
+                elapsed = time.perf_counter() - start
+            result[run + '_s'] = elapsed
+            result[run + '_requests'] = site.requests - requests_before
+            print("end_to_end latency %.3fs %-4s %8.3f s  %4d requests"
+                  % (latency, run, elapsed, result[run + '_requests']))
+    finally:
+        site.stop()
+        functions.close_browser_pool()
+        functions.close_chapter_store()
+
+    return result
+
+
+def run(args):
+    workspace = tempfile.mkdtemp(prefix='wenku2epub_bench_')
+    cwd = os.getcwd()
+
+    # The pipeline uses paths relative to 'src', mirror that layout in the workspace
+    os.makedirs(os.path.join(workspace, 'src'))
+    os.chdir(os.path.join(workspace, 'src'))
+
+    functions.configure_async_fetch(args.async_fetch)
+
+    try:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'html_parser': functions.HTML_PARSER,
+            'microbenchmarks': microbenchmarks(workspace, args.repeat),
+            'end_to_end': [end_to_end(workspace, latency, args.volumes, args.chapters) for latency in args.latency],
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for wenku2epub")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per microbenchmark")
+    parser.add_argument("--latency", type=float, nargs="*", default=[0.0, 0.05],
+                        help="response delays of the mock site in seconds, one end-to-end run each")
+    parser.add_argument("--volumes", type=int, default=2, help="volumes of the mock book")
+    parser.add_argument("--chapters", type=int, default=10, help="chapters per volume of the mock book")
+    parser.add_argument("--async-fetch", action="store_true",
+                        help="fetch chapters over the asyncio engine in the end-to-end runs (needs aiohttp)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print("run_benchmarks: Results written to %s" % args.output)
+    else:
+        print(text)
@@ -0,0 +1,265 @@
+# asyncio fetch engine for the plain HTTP path: keeps many page and image requests in flight
+# on one thread over pooled connections, paced by the shared fetch control
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse
+import asyncio
+
+from fetch_control import ThrottledError
+from http_cache import HttpCache
+from metrics import metrics
+
+# Optional dependency, without it every fetch goes through the threaded path
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Seconds between attempts to take a host slot held by other requests
+SLOT_POLL = 0.01
+
+
+def available():
+    """
+    Check if aiohttp is installed
+    """
+
+    return aiohttp is not None
+
+
+def decode_page(body, content_type):
+    """
+    Decode a page with the charset of its Content-Type, guessing it like requests does when there is none
+    (wenku8 pages are GBK encoded)
+
+    @type body: bytes
+    @param body: raw response body
+    @type content_type: str
+    @param content_type: Content-Type header, may be empty
+    """
+
+    for part in content_type.split(';')[1:]:
+        key, _, value = part.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return body.decode(value.strip('"\''), errors='replace')
+
+    import charset_normalizer  # installed with requests
+    best = charset_normalizer.from_bytes(body).best()
+    return body.decode(best.encoding if best is not None else 'utf-8', errors='replace')
+
+
+class AsyncFetcher:
+    """
+    Fetches pages and images concurrently with one aiohttp session, sharing the rate limit,
+    backoff and circuit breaker of the threaded path and its on-disk cache
+
+    @type fetch_control: fetch_control.FetchControl
+    @param fetch_control: pacing shared with every other request
+    @type http_cache: http_cache.HttpCache
+    @param http_cache: on-disk cache, None disables caching
+    @type headers: dict
+    @param headers: headers sent with every request, e.g. the user agent that solved the challenge
+    @type cookies: list
+    @param cookies: (name, value, domain, path) tuples, e.g. the Cloudflare clearance cookies
+    @type concurrency: int
+    @param concurrency: connections open at the same time over all hosts
+    @type is_challenge: function
+    @param is_challenge: returns True if a page is a Cloudflare challenge instead of the real content
+    @type max_retries: int
+    @param max_retries: attempts per request before giving up
+    """
+
+    def __init__(self, fetch_control, http_cache=None, headers=None, cookies=(), concurrency=100,
+                 is_challenge=None, max_retries=5):
+        self.fetch_control = fetch_control
+        self.http_cache = http_cache
+        self.headers = dict(headers or {})
+        self.cookies = list(cookies)
+        self.concurrency = concurrency
+        self.is_challenge = is_challenge
+        self.max_retries = max_retries
+        self.session = None
+        self._gates = {}  # host name -> asyncio.Semaphore, created inside the running loop
+
+    @asynccontextmanager
+    async def _slot(self, url):
+        # Same order as FetchControl.slot: host slot, breaker, token
+        # The host slot is the threaded path's semaphore, polled so the event loop never blocks on it.
+        # Coroutines queue on an asyncio semaphore of the same size first, so at most max_per_host of them poll
+        host = urlparse(url).netloc
+        if host not in self._gates:
+            self._gates[host] = asyncio.Semaphore(self.fetch_control.max_per_host)
+
+        async with self._gates[host]:
+            slot = self.fetch_control.semaphore(url)
+            while not slot.acquire(blocking=False):
+                await asyncio.sleep(SLOT_POLL)
+
+            try:
+                while True:
+                    remaining = self.fetch_control.breaker.remaining()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(remaining)
+
+                wait = self.fetch_control.bucket(url).reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                yield
+            finally:
+                slot.release()
+
+    async def _request(self, method, url, headers=None, challenged=None):
+        """
+        Send a request with retries, returns (status, headers, body)
+        A response challenged(status, headers, body) accepts is returned as it is, like fetch_html_http does
+        with challenges, so an old style 503 challenge is not retried as throttling
+        """
+
+        for retries in range(self.max_retries):
+            retry_after = None
+            try:
+                async with self._slot(url):
+                    async with self.session.request(method, url, headers=headers) as response:
+                        body = await response.read()
+                        status, response_headers = response.status, response.headers
+                if challenged is not None and challenged(status, response_headers, body):
+                    return status, response_headers, body
+                self.fetch_control.check_status(url, status, response_headers)
+                return status, response_headers, body
+
+            except ThrottledError as e:
+                print("async_fetch: Throttled, %s" % e)
+                retry_after = e.retry_after
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("async_fetch: %s failed: %s" % (url, e or type(e).__name__))
+
+            if retries == self.max_retries - 1:
+                break
+            # Jittered so concurrent requests do not retry in lockstep
+            await asyncio.sleep(self.fetch_control.backoff(retries, retry_after))
+
+        raise RuntimeError("async_fetch: Maximum retries reached for %s" % url)
+
+    async def fetch_page(self, url, max_age=None, store=True):
+        """
+        Fetch an HTML page through the cache, returns None if Cloudflare served a challenge
+
+        @type url: str
+        @param url: url of the page
+        @type max_age: float
+        @param max_age: seconds a cached copy is used without asking the server, None uses the cache TTL
+        @type store: bool
+        @param store: save the page to the cache, False when the caller keeps it elsewhere
+        """
+
+        with metrics.timer('download_html', url) as sample:
+            cached = self.http_cache.get(url) if self.http_cache is not None else None
+            if cached and self.http_cache.is_fresh(cached[1], max_age):
+                sample.update(source='cache', bytes=len(cached[0]))
+                return cached[0].decode('utf-8')
+
+            headers = HttpCache.validators(cached[1]) if cached else {}
+            decoded = {}
+
+            def challenged(status, response_headers, body):
+                # Checked before the status counts as throttling, the page is decoded once
+                decoded['page'] = decode_page(body, response_headers.get('Content-Type', ''))
+                decoded['challenge'] = status == 403 or \
+                    (self.is_challenge is not None and self.is_challenge(decoded['page']))
+                return decoded['challenge']
+
+            status, response_headers, body = await self._request('GET', url, headers, challenged)
+            sample.update(source='async', bytes=len(body))
+
+            if decoded['challenge']:
+                sample['ok'] = False
+                return None
+            if status == 304 and cached:
+                self.http_cache.refresh(url, cached[1])
+                return cached[0].decode('utf-8')
+
+            page = decoded['page']
+            if status >= 400:
+                raise RuntimeError("async_fetch: %s answered %d" % (url, status))
+
+            if store and self.http_cache is not None:
+                self.http_cache.store(url, page.encode('utf-8'), response_headers)
+            return page
+
+    async def fetch_bytes(self, url):
+        """
+        GET an image or other binary file through the cache, returns (content, content type)
+
+        @type url: str
+        @param url: url to fetch
+        """
+
+        with metrics.timer('download_image', url) as sample:
+            cached = self.http_cache.get(url) if self.http_cache is not None else None
+            if cached and self.http_cache.is_fresh(cached[1]):
+                sample.update(source='cache', bytes=len(cached[0]))
+                return cached[0], cached[1].get('content_type')
+
+            headers = HttpCache.validators(cached[1]) if cached else {}
+            status, response_headers, body = await self._request('GET', url, headers)
+
+            if status == 304 and cached:
+                self.http_cache.refresh(url, cached[1])
+                return cached[0], cached[1].get('content_type')
+            if status >= 400:
+                raise RuntimeError("async_fetch: %s answered %d" % (url, status))
+
+            if self.http_cache is not None:
+                self.http_cache.store(url, body, response_headers)
+            sample.update(source='async', bytes=len(body))
+            return body, response_headers.get('Content-Type')
+
+    def _cookie_jar(self):
+        jar = aiohttp.CookieJar(unsafe=True)  # unsafe also keeps cookies for IP addresses
+        for name, value, domain, path in self.cookies:
+            cookie = SimpleCookie()
+            cookie[name] = value
+            if domain:
+                cookie[name]['domain'] = domain
+            cookie[name]['path'] = path or '/'
+            jar.update_cookies(cookie)
+        return jar
+
+    async def _run(self, jobs, on_result):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=30)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers,
+                                         cookie_jar=self._cookie_jar()) as session:
+            self.session = session
+
+            async def run_job(key, func, *args):
+                try:
+                    return key, await func(*args), None
+                except Exception as e:
+                    return key, None, e
+
+            try:
+                for finished in asyncio.as_completed([run_job(*job) for job in jobs]):
+                    on_result(*(await finished))
+            finally:
+                self.session = None
+                self._gates = {}
+
+    def fetch_all(self, jobs, on_result):
+        """
+        Run every job on a new event loop, on_result(key, result, error) is called as each one
+        finishes, in completion order, so results can be handed on while the rest are in flight
+
+        @type jobs: list
+        @param jobs: (key, coroutine function, arguments...) tuples, e.g. (chapter, fetcher.fetch_page, url)
+        @type on_result: function
+        @param on_result: receives the key, the return value and the exception (None on success)
+        """
+
+        asyncio.run(self._run(jobs, on_result))
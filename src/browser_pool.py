@@ -0,0 +1,231 @@
+# Keeps a small pool of long-lived headless Chrome sessions used by functions.py
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
+from contextlib import contextmanager
+import threading
+import queue
+
+# Resources the 'lean' profile never downloads, only page_source is kept, so images, stylesheets,
+# fonts and media are wasted bandwidth. Scripts still load, the Cloudflare check needs them
+LEAN_BLOCKED_URLS = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.bmp', '*.svg', '*.ico',
+                     '*.css', '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot', '*.mp3', '*.mp4', '*.webm']
+# URL patterns blocked by each profile, chosen per request with session(profile=...)
+PROFILES = {'lean': LEAN_BLOCKED_URLS, 'full': []}
+
+
+def default_options():
+    """
+    Chrome options used by every pooled browser session
+    """
+
+    options = Options()
+    options.add_argument("--headless=new")   # Try headless, fallback if Cloudflare blocks it
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument("start-maximized")
+    return options
+
+
+def lean_options():
+    """
+    Chrome options for sessions that only read page sources: small window, small disk cache and
+    eager page loading, driver.get returns once the HTML is parsed instead of after every
+    image and ad has loaded (callers wait for their ready selector anyway)
+    """
+
+    options = Options()
+    options.add_argument("--headless=new")
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument("--window-size=1024,768")
+    options.add_argument("--disk-cache-size=%d" % (16 * 1024 * 1024))
+    options.add_argument("--disable-extensions")
+    options.add_argument("--mute-audio")
+    options.page_load_strategy = 'eager'
+    return options
+
+
+class BrowserPool:
+    """
+    Pool of warm Chrome sessions, browsers are started lazily and reused across pages
+
+    @type size: int
+    @param size: maximum number of browser sessions alive at the same time
+    @type max_pages: int
+    @param max_pages: number of pages a session may load before it is recycled
+    @type options_factory: function
+    @param options_factory: returns the selenium Options used to start a new session
+    """
+
+    def __init__(self, size=1, max_pages=50, options_factory=default_options):
+        self.size = size
+        self.max_pages = max_pages
+        self.options_factory = options_factory
+
+        self._idle = queue.LifoQueue()  # idle sessions, None for a slot freed by _discard
+        self._page_count = {}
+        self._profile = {}  # id(driver) -> profile the session is set up for
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _start_driver(self):
+        """
+        Launch a new Chrome session
+        """
+
+        print("BrowserPool: Starting new Chrome session (%d/%d) ..." % (self._created, self.size))
+        return webdriver.Chrome(options=self.options_factory())
+
+    @staticmethod
+    def _is_healthy(driver):
+        """
+        Check that the browser session still responds to commands
+
+        @type driver: webdriver.Chrome
+        @param driver: pooled browser session
+        """
+
+        try:
+            driver.execute_script("return 1")
+            return True
+        except WebDriverException:
+            return False
+
+    def _discard(self, driver):
+        """
+        Quit a browser session and free its slot in the pool, waking a thread waiting in acquire()
+
+        @type driver: webdriver.Chrome
+        @param driver: pooled browser session
+        """
+
+        try:
+            driver.quit()
+        except WebDriverException as e:
+            print(f"BrowserPool: Error while quitting browser: {e}")
+
+        with self._lock:
+            self._page_count.pop(id(driver), None)
+            self._profile.pop(id(driver), None)
+            self._created -= 1
+        # A waiter blocked on the idle queue would never see the free slot otherwise
+        self._idle.put(None)
+
+    def _apply_profile(self, driver, profile):
+        """
+        Block the resources of profile in a session, only sends commands when the profile changes
+
+        @type driver: webdriver.Chrome
+        @param driver: pooled browser session
+        @type profile: str
+        @param profile: key of PROFILES
+        """
+
+        if self._profile.get(id(driver)) == profile:
+            return
+
+        try:
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': PROFILES[profile]})
+        except (WebDriverException, AttributeError) as e:
+            # Not a Chromium session, pages still load, only without blocking
+            print("BrowserPool: Cannot block resources for profile '%s': %s" % (profile, e))
+        self._profile[id(driver)] = profile
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a healthy browser session, start a new one if the pool is not full yet
+
+        @type timeout: float
+        @param timeout: seconds to wait for a free session, None waits forever
+        """
+
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+
+                if can_create:
+                    try:
+                        driver = self._start_driver()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                    with self._lock:
+                        self._page_count[id(driver)] = 0
+                    return driver
+
+                driver = self._idle.get(timeout=timeout)
+
+            if driver is None:
+                # A session was discarded, start a new one in its slot unless another thread took it
+                continue
+            if self._is_healthy(driver):
+                return driver
+
+            print("BrowserPool: Browser session failed health check, recycling ...")
+            self._discard(driver)
+
+    def release(self, driver, broken=False):
+        """
+        Return a browser session to the pool, recycle it if it crashed or reached max_pages
+
+        @type driver: webdriver.Chrome
+        @param driver: pooled browser session
+        @type broken: bool
+        @param broken: True if the session raised an error while in use
+        """
+
+        with self._lock:
+            self._page_count[id(driver)] = self._page_count.get(id(driver), 0) + 1
+            worn_out = self._page_count[id(driver)] >= self.max_pages
+
+        if broken or worn_out:
+            print("BrowserPool: Recycling browser session (%s)" % ("crashed" if broken else "page limit reached"))
+            self._discard(driver)
+        else:
+            self._idle.put(driver)
+
+    @contextmanager
+    def session(self, timeout=None, profile='full'):
+        """
+        Borrow a browser session for the duration of a with-block
+
+        @type timeout: float
+        @param timeout: seconds to wait for a free session, None waits forever
+        @type profile: str
+        @param profile: 'lean' blocks images, stylesheets, fonts and media, 'full' loads everything
+        """
+
+        driver = self.acquire(timeout)
+        try:
+            self._apply_profile(driver, profile)
+            yield driver
+        except Exception:
+            self.release(driver, broken=True)
+            raise
+        else:
+            self.release(driver)
+
+    def close(self):
+        """
+        Quit every idle browser session
+        """
+
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if driver is not None:
+                self._discard(driver)
+
+        print("BrowserPool: All browser sessions closed")
@@ -0,0 +1,203 @@
+# Compact model of a book index: volumes and their chapters in reading order
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import hashlib
+import json
+import os
+
+
+class Chapter:
+    """
+    One chapter link of the index page
+
+    @type chapter_id: str
+    @param chapter_id: id taken from the chapter URL, e.g. '1234' for '1234.htm', unique within a book
+    @type title: str
+    @param title: chapter name, not unique
+    @type url: str
+    @param url: absolute URL of the chapter page
+    @type order: int
+    @param order: position of the chapter inside its volume, starting at 0
+    """
+
+    __slots__ = ('chapter_id', 'title', 'url', 'order')
+
+    def __init__(self, chapter_id, title, url, order):
+        self.chapter_id = chapter_id
+        self.title = title
+        self.url = url
+        self.order = order
+
+    def __repr__(self):
+        return "Chapter(%r, %r)" % (self.chapter_id, self.title)
+
+    def to_dict(self):
+        return {'chapter_id': self.chapter_id, 'title': self.title, 'url': self.url, 'order': self.order}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['chapter_id'], data['title'], data['url'], data['order'])
+
+
+class Volume:
+    """
+    One volume heading of the index page and the chapters listed under it
+
+    @type name: str
+    @param name: output name of the volume, book title plus e.g. ' 第一卷'
+    @type order: int
+    @param order: position of the volume in the index, starting at 0
+    @type chapters: list
+    @param chapters: Chapter records in reading order
+    @type cover_url: str
+    @param cover_url: url of the image chosen as cover, None until the volume has been fetched
+    """
+
+    __slots__ = ('name', 'order', 'chapters', 'cover_url')
+
+    def __init__(self, name, order, chapters=None, cover_url=None):
+        self.name = name
+        self.order = order
+        self.chapters = chapters if chapters is not None else []
+        self.cover_url = cover_url
+
+    def __repr__(self):
+        return "Volume(%r, %d chapters)" % (self.name, len(self.chapters))
+
+    def to_dict(self):
+        return {'name': self.name, 'order': self.order, 'cover_url': self.cover_url,
+                'chapters': [chapter.to_dict() for chapter in self.chapters]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['order'], [Chapter.from_dict(chapter) for chapter in data['chapters']],
+                   data.get('cover_url'))
+
+
+class Catalog:
+    """
+    Everything extract_index reads from the index page
+
+    @type title: str
+    @param title: book title
+    @type author: str
+    @param author: author name
+    @type volumes: list
+    @param volumes: Volume records in index order
+    """
+
+    __slots__ = ('title', 'author', 'volumes')
+
+    def __init__(self, title, author, volumes=None):
+        self.title = title
+        self.author = author
+        self.volumes = volumes if volumes is not None else []
+
+    def __repr__(self):
+        return "Catalog(%r, %d volumes)" % (self.title, len(self.volumes))
+
+    def to_dict(self):
+        return {'title': self.title, 'author': self.author,
+                'volumes': [volume.to_dict() for volume in self.volumes]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['title'], data['author'], [Volume.from_dict(volume) for volume in data['volumes']])
+
+
+def snapshot_path(index_url, directory="../catalog"):
+    """
+    Snapshot file name for a book, one snapshot per index URL
+
+    @type index_url: str
+    @param index_url: url to the index page
+    @type directory: str
+    @param directory: folder holding the snapshots
+    """
+
+    key = hashlib.sha1(index_url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, key + '.json')
+
+
+def load_snapshot(path):
+    """
+    Catalog saved by the last successful run, None if the book was never converted
+
+    @type path: str
+    @param path: snapshot file
+    """
+
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return Catalog.from_dict(json.load(f))
+
+
+def save_snapshot(catalog, path, previous=None):
+    """
+    Save the catalog of the volumes just converted, volumes only found in the previous
+    snapshot are kept so converting a subset does not forget the rest
+
+    @type catalog: Catalog
+    @param catalog: catalog of the live index
+    @type path: str
+    @param path: snapshot file
+    @type previous: Catalog
+    @param previous: snapshot loaded before the run, None if there was none
+    """
+
+    snapshot = Catalog(catalog.title, catalog.author, list(catalog.volumes))
+    if previous is not None:
+        # Volumes skipped by an update run keep the cover chosen when they were converted
+        old_covers = {volume.name: volume.cover_url for volume in previous.volumes}
+        for volume in snapshot.volumes:
+            if volume.cover_url is None:
+                volume.cover_url = old_covers.get(volume.name)
+
+        names = set(volume.name for volume in catalog.volumes)
+        snapshot.volumes += [volume for volume in previous.volumes if volume.name not in names]
+        snapshot.volumes.sort(key=lambda volume: volume.order)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot.to_dict(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def diff_catalogs(previous, catalog):
+    """
+    Compare the live index with the last snapshot
+    Returns (names of volumes that are new or whose chapter list changed, ids of chapters that did not change)
+
+    @type previous: Catalog
+    @param previous: snapshot of the last run, None if there was none
+    @type catalog: Catalog
+    @param catalog: catalog of the live index
+    """
+
+    if previous is None:
+        return [volume.name for volume in catalog.volumes], set()
+
+    def chapter_key(chapter):
+        return chapter.chapter_id, chapter.title, chapter.url
+
+    old_volumes = {volume.name: volume for volume in previous.volumes}
+    old_chapters = set(chapter_key(chapter) for volume in previous.volumes for chapter in volume.chapters)
+
+    changed = []
+    unchanged_chapters = set()
+
+    for volume in catalog.volumes:
+        old_volume = old_volumes.get(volume.name)
+        new_keys = [chapter_key(chapter) for chapter in volume.chapters]
+        if old_volume is None or [chapter_key(chapter) for chapter in old_volume.chapters] != new_keys:
+            changed.append(volume.name)
+
+        for chapter in volume.chapters:
+            if chapter_key(chapter) in old_chapters:
+                unchanged_chapters.add(chapter.chapter_id)
+
+    return changed, unchanged_chapters
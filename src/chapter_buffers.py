@@ -0,0 +1,105 @@
+# In-memory chapter files: chapters move from download to cleaning to the epub without going through '../temp',
+# until a memory budget is used up and further chapters are spilled to their files as before
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import os
+import threading
+
+
+class ChapterBuffers:
+    """
+    File contents kept in memory under their file names, up to budget bytes in total
+    A file that does not fit is written to disk instead, callers read it back the same way
+
+    @type budget: int
+    @param budget: bytes of chapter data kept in memory at most
+    """
+
+    def __init__(self, budget=256 * 1024 * 1024):
+        self.budget = budget
+        self.used = 0
+        self.spilled = 0  # number of files written to disk because the budget was used up
+        self._files = {}  # file name -> bytes
+        self._lock = threading.Lock()
+
+    def write(self, path, data):
+        """
+        Keep data as the content of path, in memory if it fits in the budget, on disk otherwise
+
+        @type path: str
+        @param path: file name the data belongs to
+        @type data: bytes
+        @param data: file content
+        """
+
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self.used -= len(old)
+            if self.used + len(data) <= self.budget:
+                self._files[path] = data
+                self.used += len(data)
+                return
+            self.spilled += 1
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        """
+        Content of path, from memory or from the spilled file
+
+        @type path: str
+        @param path: file name
+        """
+
+        with self._lock:
+            data = self._files.get(path)
+        if data is not None:
+            return data
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def content(self, path):
+        """
+        Bytes of an in-memory file or the name of a spilled one, the two forms compress_epub takes
+
+        @type path: str
+        @param path: file name
+        """
+
+        with self._lock:
+            data = self._files.get(path)
+        return data if data is not None else path
+
+    def remove(self, path):
+        """
+        Forget a file, deleting it from disk if it was spilled
+
+        @type path: str
+        @param path: file name
+        """
+
+        with self._lock:
+            data = self._files.pop(path, None)
+            if data is not None:
+                self.used -= len(data)
+                return
+        if os.path.exists(path):
+            os.remove(path)
+
+    def release(self, folder):
+        """
+        Free every in-memory file inside folder, call once its volume is packed
+
+        @type folder: str
+        @param folder: temp folder of a volume
+        """
+
+        prefix = folder.rstrip('/') + '/'
+        with self._lock:
+            for path in [path for path in self._files if path.startswith(prefix)]:
+                self.used -= len(self._files.pop(path))
@@ -0,0 +1,247 @@
+# Persistent, compressed store of every chapter downloaded, raw page and cleaned XHTML, plus the cover and
+# illustration images, shared between runs
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from urllib.parse import urlparse
+import hashlib
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+import zlib
+
+# Seconds a connection waits for another process to release the database before "database is locked",
+# the job queue uses the same, workers write to both databases at once
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    book_id TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    chapter_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    url TEXT NOT NULL,
+    raw BLOB,
+    raw_hash TEXT,
+    fetched_at REAL,
+    cleaned BLOB,
+    cleaner_version INTEGER,
+    cleaned_at REAL,
+    PRIMARY KEY (book_id, volume, chapter_id)
+);
+CREATE INDEX IF NOT EXISTS chapters_by_volume ON chapters (book_id, volume, position);
+CREATE TABLE IF NOT EXISTS images (
+    url TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    content_type TEXT,
+    fetched_at REAL
+);
+"""
+
+
+def book_id(url):
+    """
+    Book id shared by the index page and the chapter pages, e.g. '1234' for
+    'https://www.wenku8.net/novel/1/1234/index.htm' and '.../novel/1/1234/5678.htm'
+
+    @type url: str
+    @param url: url of the index page or of a chapter
+    """
+
+    folder = posixpath.dirname(urlparse(url).path)
+    return posixpath.basename(folder) or folder
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def decompress(data):
+    return zlib.decompress(data).decode('utf-8') if data is not None else None
+
+
+class ChapterStore:
+    """
+    SQLite database with one row per chapter, keyed by (book id, volume name, chapter id)
+    Text is stored zlib compressed. Storing a raw page that differs from the stored one drops
+    the cleaned version, so cleaned text always belongs to the raw page next to it
+
+    @type path: str
+    @param path: database file, created with its folder on first use
+    """
+
+    def __init__(self, path="../store/chapters.sqlite3"):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Opened on first use, so creating the store never touches the disk
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def put_raw(self, book, volume, chapter, html):
+        """
+        Save the downloaded page of a chapter
+
+        @type book: str
+        @param book: book id, see book_id()
+        @type volume: str
+        @param volume: volume name
+        @type chapter: catalog.Chapter
+        @param chapter: chapter the page belongs to
+        @type html: str
+        @param html: page source
+        """
+
+        raw_hash = hashlib.sha1(html.encode('utf-8')).hexdigest()
+        with self._lock:
+            db = self._connect()
+            # Every right-hand side sees the old row, so a changed page clears the cleaned text
+            db.execute("""
+                INSERT INTO chapters (book_id, volume, chapter_id, position, title, url, raw, raw_hash, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (book_id, volume, chapter_id) DO UPDATE SET
+                    position = excluded.position, title = excluded.title, url = excluded.url,
+                    raw = excluded.raw, raw_hash = excluded.raw_hash, fetched_at = excluded.fetched_at,
+                    cleaned = CASE WHEN raw_hash = excluded.raw_hash THEN cleaned END,
+                    cleaner_version = CASE WHEN raw_hash = excluded.raw_hash THEN cleaner_version END,
+                    cleaned_at = CASE WHEN raw_hash = excluded.raw_hash THEN cleaned_at END
+            """, (book, volume, chapter.chapter_id, chapter.order, chapter.title, chapter.url,
+                  compress(html), raw_hash, time.time()))
+            db.commit()
+
+    def put_cleaned(self, book, volume, chapter_id, xhtml, cleaner_version):
+        """
+        Save the cleaned XHTML of a chapter whose raw page is already stored
+
+        @type book: str
+        @param book: book id
+        @type volume: str
+        @param volume: volume name
+        @type chapter_id: str
+        @param chapter_id: chapter id
+        @type xhtml: str
+        @param xhtml: chapter file written by clean_chapter
+        @type cleaner_version: int
+        @param cleaner_version: version of the cleaning code, older cleaned text is ignored by cleaned()
+        """
+
+        with self._lock:
+            db = self._connect()
+            db.execute("UPDATE chapters SET cleaned = ?, cleaner_version = ?, cleaned_at = ? "
+                       "WHERE book_id = ? AND volume = ? AND chapter_id = ?",
+                       (compress(xhtml), cleaner_version, time.time(), book, volume, chapter_id))
+            db.commit()
+
+    def raw(self, book, volume, chapter_id):
+        """
+        Downloaded page of a chapter, None if it is not stored
+
+        @type book: str
+        @param book: book id
+        @type volume: str
+        @param volume: volume name
+        @type chapter_id: str
+        @param chapter_id: chapter id
+        """
+
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT raw FROM chapters WHERE book_id = ? AND volume = ? AND chapter_id = ?",
+                (book, volume, chapter_id)).fetchone()
+        return decompress(row[0]) if row is not None else None
+
+    def cleaned(self, book, volume, chapter_id, cleaner_version):
+        """
+        Cleaned XHTML of a chapter, None if it was never cleaned or by another version of the cleaning code
+
+        @type book: str
+        @param book: book id
+        @type volume: str
+        @param volume: volume name
+        @type chapter_id: str
+        @param chapter_id: chapter id
+        @type cleaner_version: int
+        @param cleaner_version: current version of the cleaning code
+        """
+
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT cleaned FROM chapters WHERE book_id = ? AND volume = ? AND chapter_id = ? "
+                "AND cleaner_version = ?", (book, volume, chapter_id, cleaner_version)).fetchone()
+        return decompress(row[0]) if row is not None else None
+
+    def volume_chapters(self, book, volume, cleaner_version=None):
+        """
+        Every stored chapter of a volume in one query, as {chapter id: dict} with the keys
+        'title', 'url', 'position', 'raw', 'cleaned' and 'fetched_at'
+        'cleaned' is None unless it was made by cleaner_version (any version if None)
+
+        @type book: str
+        @param book: book id
+        @type volume: str
+        @param volume: volume name
+        @type cleaner_version: int
+        @param cleaner_version: current version of the cleaning code
+        """
+
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT chapter_id, title, url, position, raw, cleaned, cleaner_version, fetched_at "
+                "FROM chapters WHERE book_id = ? AND volume = ? ORDER BY position", (book, volume)).fetchall()
+
+        chapters = {}
+        for chapter_id, title, url, position, raw, cleaned, version, fetched_at in rows:
+            if cleaner_version is not None and version != cleaner_version:
+                cleaned = None
+            chapters[chapter_id] = {'title': title, 'url': url, 'position': position, 'raw': decompress(raw),
+                                    'cleaned': decompress(cleaned), 'fetched_at': fetched_at}
+        return chapters
+
+    def put_image(self, url, content, content_type=None):
+        """
+        Save a cover or illustration, images are already compressed and stored as they are
+
+        @type url: str
+        @param url: url of the image
+        @type content: bytes
+        @param content: image data
+        @type content_type: str
+        @param content_type: Content-Type header of the image
+        """
+
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO images (url, content, content_type, fetched_at) VALUES (?, ?, ?, ?)",
+                       (url, content, content_type, time.time()))
+            db.commit()
+
+    def image(self, url):
+        """
+        (content, content type) of a stored image, None if it is not stored
+
+        @type url: str
+        @param url: url of the image
+        """
+
+        with self._lock:
+            row = self._connect().execute("SELECT content, content_type FROM images WHERE url = ?",
+                                          (url,)).fetchone()
+        return (bytes(row[0]), row[1]) if row is not None else None
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
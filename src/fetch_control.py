@@ -0,0 +1,294 @@
+# Shared request pacing for every fetch: per-host token buckets and concurrency limits,
+# jittered exponential backoff and a circuit breaker that pauses the crawl when the site throttles us
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import random
+import threading
+import time
+
+# Status codes that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUS = (429, 503)
+
+
+class ThrottledError(Exception):
+    """
+    The server answered 429 or 503, retry_after holds the seconds it asked us to wait (None if it did not say)
+    """
+
+    def __init__(self, url, status, retry_after=None):
+        super().__init__("%s answered %d%s" % (url, status,
+                                               ", Retry-After %.0f s" % retry_after if retry_after else ""))
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date
+
+    @type value: str
+    @param value: header value, None if the header was missing
+    """
+
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average with bursts of up to burst requests
+
+    @type rate: float
+    @param rate: tokens added per second, None or 0 for no limit
+    @type burst: int
+    @param burst: maximum number of tokens saved up while idle
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token, returns the seconds the caller has to wait before using it
+        Tokens may go negative, so callers are served in the order they asked
+        """
+
+        if not self.rate:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it may be used
+        """
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive throttled responses and pauses every fetch once there are too many
+    After the pause one more throttled response opens it again, a successful response resets it
+
+    @type threshold: int
+    @param threshold: consecutive throttled responses that open the breaker
+    @type cooldown: float
+    @param cooldown: seconds every fetch is paused for once the breaker opens
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """
+        Seconds until the breaker closes again, 0 if it is closed
+        """
+
+        with self._lock:
+            return max(0.0, self.open_until - time.monotonic())
+
+    def wait(self):
+        """
+        Block while the breaker is open
+        """
+
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def pause(self, seconds):
+        """
+        Keep every fetch waiting for at least the given number of seconds
+
+        @type seconds: float
+        @param seconds: length of the pause
+        """
+
+        with self._lock:
+            self.open_until = max(self.open_until, time.monotonic() + seconds)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_throttle(self, retry_after=None):
+        """
+        Count a throttled response, honouring its Retry-After for everyone
+
+        @type retry_after: float
+        @param retry_after: seconds the server asked us to wait, None if it did not say
+        """
+
+        with self._lock:
+            self.failures += 1
+            tripped = self.failures >= self.threshold
+            if tripped:
+                # Half-open: the next throttled response after the pause trips it again
+                self.failures = self.threshold - 1
+
+        if retry_after:
+            self.pause(retry_after)
+        if tripped:
+            seconds = max(self.cooldown, retry_after or 0)
+            print("circuit_breaker: Site is throttling requests, pausing all fetches for %.0f seconds" % seconds)
+            self.pause(seconds)
+
+
+class FetchControl:
+    """
+    Pacing shared by every request path: browser pages, plain HTTP pages and images
+
+    @type rate: float
+    @param rate: requests per second allowed to each host, None for no limit
+    @type burst: int
+    @param burst: requests a host may receive back to back after being idle
+    @type max_per_host: int
+    @param max_per_host: requests in flight to the same host at once
+    @type breaker_threshold: int
+    @param breaker_threshold: consecutive throttled responses that pause the whole crawl
+    @type breaker_cooldown: float
+    @param breaker_cooldown: seconds the crawl is paused for
+    @type base_delay: float
+    @param base_delay: backoff of the first retry in seconds, doubled on every further retry
+    @type max_delay: float
+    @param max_delay: longest backoff in seconds, not counting Retry-After
+    @type bucket_factory: function
+    @param bucket_factory: returns the token bucket of a host name, e.g. a job_queue.SharedTokenBucket
+                           shared with other processes, None gives every host a TokenBucket of this process
+    """
+
+    def __init__(self, rate=None, burst=1, max_per_host=2, breaker_threshold=5, breaker_cooldown=60,
+                 base_delay=2, max_delay=60, bucket_factory=None):
+        self.rate = rate
+        self.burst = burst
+        self.bucket_factory = bucket_factory
+        self.max_per_host = max_per_host
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.buckets = {}  # host name -> TokenBucket
+        self.slots = {}  # host name -> semaphore limiting requests in flight
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.max_per_host)
+                self.buckets[host] = self.bucket_factory(host) if self.bucket_factory is not None \
+                    else TokenBucket(self.rate, self.burst)
+            return self.slots[host], self.buckets[host]
+
+    def bucket(self, url):
+        """
+        Token bucket of the host of url, for callers that cannot block such as the asyncio engine
+
+        @type url: str
+        @param url: url about to be fetched
+        """
+
+        return self._host(url)[1]
+
+    def semaphore(self, url):
+        """
+        Semaphore limiting the requests in flight to the host of url, shared by the threaded path
+        and the asyncio engine so both stay within max_per_host together
+
+        @type url: str
+        @param url: url about to be fetched
+        """
+
+        return self._host(url)[0]
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Hold a request slot for the host of url: waits for the breaker, a free slot and a token
+
+        @type url: str
+        @param url: url about to be fetched
+        """
+
+        slot, bucket = self._host(url)
+        with slot:
+            self.breaker.wait()
+            bucket.acquire()
+            yield
+
+    def check_response(self, url, response):
+        """
+        Raise ThrottledError for 429/503 responses and feed the result to the circuit breaker
+
+        @type url: str
+        @param url: url that was fetched
+        @type response: requests.Response
+        @param response: response of the server
+        """
+
+        self.check_status(url, response.status_code, response.headers)
+
+    def check_status(self, url, status, headers):
+        """
+        Same as check_response for clients without a requests.Response, e.g. aiohttp
+
+        @type url: str
+        @param url: url that was fetched
+        @type status: int
+        @param status: HTTP status code
+        @type headers: dict
+        @param headers: response headers
+        """
+
+        if status in THROTTLE_STATUS:
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            self.breaker.record_throttle(retry_after)
+            raise ThrottledError(url, status, retry_after)
+
+        self.breaker.record_success()
+
+    def backoff(self, retries, retry_after=None):
+        """
+        Seconds to wait before the next attempt: exponential with jitter so concurrent
+        fetchers do not retry in lockstep, never shorter than the server's Retry-After
+
+        @type retries: int
+        @param retries: number of attempts that already failed, minus one
+        @type retry_after: float
+        @param retry_after: seconds the server asked us to wait, None if it did not say
+        """
+
+        delay = min(self.max_delay, self.base_delay * 2 ** retries)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        return max(delay, retry_after or 0)
@@ -5,153 +5,1000 @@
 
 # Import dependencies
 #import requests
-import cloudscraper
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import WebDriverException
-from bs4 import BeautifulSoup
-import validators
+# cloudscraper, selenium, aiohttp, validators and bs4 are imported where they are first needed,
+# so offline jobs such as rebuilding from the cache never load the network or browser stack
+from http_cache import HttpCache
+from fetch_control import FetchControl, ThrottledError
+from catalog import Catalog, Volume, Chapter
+from chapter_store import ChapterStore, book_id
+from chapter_buffers import ChapterBuffers
+from metrics import metrics
+import importlib.util
 import os
+import posixpath
 import shutil
 from textwrap import dedent
-from datetime import datetime
+from xml.sax.saxutils import escape
+import hashlib
+import json
 import zipfile
+import io
 import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Optional fast HTML parser, falls back to Python's built-in html.parser (looked up without importing it)
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+
+# Optional image library used to downscale illustrations, imported by downscale_image when it is needed
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
 
 # Global variables
-scraper = cloudscraper.create_scraper()  # returns a CloudScraper instance
+scraper = None  # CloudScraper instance, created by get_scraper() on first use
+lazy_init_lock = threading.Lock()
+browser_pool = None  # Created by get_browser_pool() on first use, its Chrome sessions are reused for every page
+browser_pool_size = 1
+browser_pool_max_pages = 50
+lean_browser = True  # Start sessions with browser_pool.lean_options: eager page loading, small window and cache
+# Browser profile per kind of page, 'lean' blocks images, stylesheets, fonts and media, 'full' loads everything
+browser_profiles = {'index': 'lean', 'chapter': 'lean', 'illustrations': 'lean'}
+offline = False  # Serve every page and image from the on-disk cache and never touch the network
+fetch_control = FetchControl()  # Rate limit, backoff and circuit breaker shared by every request
+use_async_fetch = False  # Fetch chapters and illustrations over the asyncio engine once clearance is known
+async_concurrency = 100  # Connections the asyncio engine keeps open over all hosts
+http_cache = HttpCache()  # Pages and images kept in '../cache' between runs, None disables caching
+chapter_store = ChapterStore()  # Raw and cleaned chapters kept in '../store' between runs, None disables it
+CLEANER_VERSION = 2  # Bump when the output of clean_chapter changes, older cleaned chapters are then redone
+chapter_buffers = None  # Chapters kept in memory from download to epub, set by configure_memory_path, None uses files
+
+# Cover of a book by shard folder and book id, as in /novel/<shard>/<book id>/index.htm
+INDEX_COVER_URL = 'https://img.wenku8.com/image/%s/%s/%ss.jpg'
+
+# CSS selectors that mark a page as fully loaded
+CHAPTER_READY = '#content'
+INDEX_READY = '#title, td.vcss'
+# Elements and titles shown while Cloudflare is checking the browser
+CHALLENGE_SELECTORS = '#challenge-form, #cf-challenge-running, .cf-browser-verification'
+CHALLENGE_TITLES = ('Just a moment', 'Attention Required')
+# Markers of a Cloudflare challenge in raw HTML returned over plain HTTP
+CHALLENGE_MARKERS = ('challenge-form', 'cf-challenge-running', 'cf-browser-verification', '<title>Just a moment')
+# Only these parts of a page are built into the BeautifulSoup tree, arguments of bs4.SoupStrainer
+CONTENT_STRAINER = {'id': 'content'}
+IMAGE_STRAINER = {'name': 'img'}
+# Characters XML 1.0 does not allow even when escaped, e.g. control characters left in a page
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Chapters bigger than this are split into several files in the epub, e-readers paginate huge files slowly
+CHAPTER_SPLIT_BYTES = 200 * 1024
+# Time stamped into every epub (dcterms:modified and the zip entries), so the same input always gives
+# the same file, 1980-01-01 (the earliest zip date) unless the SOURCE_DATE_EPOCH convention sets one
+EPUB_EPOCH = int(os.environ.get('SOURCE_DATE_EPOCH', 315532800))
+# Hash of the parts of every epub written, an epub whose parts did not change is not written again,
+# None rebuilds every time
+build_cache_dir = "../store/builds"
+
+use_http_fetch = True  # Fetch pages over cloudscraper once the browser has solved the challenge
+clearance_ready = False  # True once browser cookies have been copied into scraper
+clearance_lock = threading.Lock()
+
+embed_illustrations = False  # Put every image of the '插图' chapter into the book, not only the cover
+illustration_workers = 4  # Number of illustrations downloaded in parallel
+illustration_max_size = None  # Longest side in pixels illustrations are downscaled to, None keeps them as they are
+illustration_quality = 85  # JPEG quality of downscaled illustrations
+IMAGE_MEDIA_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+                     '.webp': 'image/webp'}
+
+
+def configure_browser_pool(size=1, max_pages=50, lean=True, profiles=None):
+    """
+    Replace the global browser pool, closing any sessions held by the old one
+
+    @type size: int
+    @param size: maximum number of browser sessions alive at the same time
+    @type max_pages: int
+    @param max_pages: number of pages a session may load before it is recycled
+    @type lean: bool
+    @param lean: start sessions with eager page loading, a small window and a small disk cache
+    @type profiles: dict
+    @param profiles: 'lean' or 'full' for 'index', 'chapter' and 'illustrations' pages, missing ones keep their profile
+    """
+
+    global browser_pool, browser_pool_size, browser_pool_max_pages, lean_browser
+    close_browser_pool()
+    browser_pool = None
+    browser_pool_size = size
+    browser_pool_max_pages = max_pages
+    lean_browser = lean
+    browser_profiles.update(profiles or {})
+
+
+def get_browser_pool():
+    """
+    Global browser pool, created (and selenium imported) on first use
+    """
+
+    global browser_pool
+    with lazy_init_lock:
+        if browser_pool is None:
+            from browser_pool import BrowserPool, default_options, lean_options
+            browser_pool = BrowserPool(size=browser_pool_size, max_pages=browser_pool_max_pages,
+                                       options_factory=lean_options if lean_browser else default_options)
+        return browser_pool
+
+
+def get_scraper():
+    """
+    Global cloudscraper session, created on first use
+    """
+
+    global scraper
+    with lazy_init_lock:
+        if scraper is None:
+            import cloudscraper
+            scraper = cloudscraper.create_scraper()  # returns a CloudScraper instance
+        return scraper
 
-def create_temp_dir():
+
+def configure_offline(enabled=True):
     """
-    Create temporary directories, if directories already exists, then it will be removed
+    Set whether pages and images only come from the on-disk cache, a missing entry fails the download
+    instead of fetching it
+
+    @type enabled: bool
+    @param enabled: never touch the network
     """
 
-    dir_list = ["../temp", "../book", "../book/META-INF", "../book/OEBPS"]
-    for directory in dir_list:
-        if os.path.exists(directory):
-            shutil.rmtree(directory)
-        os.makedirs(directory)
-        print("create_temp_dir: Directory '%s' created" % directory)
+    global offline
+    offline = enabled
 
 
-def delete_temp_dir():
+def configure_fetch_control(max_per_host=2, rate=None, burst=1, breaker_threshold=5, breaker_cooldown=60,
+                            bucket_factory=None):
     """
-    Permanently delete temporary directories
+    Replace the shared fetch control used by every request
+
+    @type max_per_host: int
+    @param max_per_host: politeness limit of requests in flight to the same host
+    @type rate: float
+    @param rate: requests per second allowed to each host, None for no limit
+    @type burst: int
+    @param burst: requests a host may receive back to back after being idle
+    @type breaker_threshold: int
+    @param breaker_threshold: consecutive 429/503 responses that pause every fetch
+    @type breaker_cooldown: float
+    @param breaker_cooldown: seconds every fetch is paused for
+    @type bucket_factory: function
+    @param bucket_factory: token bucket of a host name, used to share the rate limit between processes
     """
 
-    # Delete temp folders '../book' and '../temp'
-    dir_list = ["../temp", "../book"]
-    for directory in dir_list:
-        shutil.rmtree(directory, ignore_errors=False, onerror=None)
-        print("delete_temp_dir: Directory '%s' deleted" % directory)
+    global fetch_control
+    fetch_control = FetchControl(rate=rate, burst=burst, max_per_host=max_per_host,
+                                 breaker_threshold=breaker_threshold, breaker_cooldown=breaker_cooldown,
+                                 bucket_factory=bucket_factory)
 
 
-def scrape_book(volume_name, chapter_list, cover_file):
+def configure_async_fetch(enabled=True, concurrency=100):
+    """
+    Set whether chapters and illustrations are fetched over the asyncio engine (needs aiohttp)
+    Requests in flight per host are still limited by configure_fetch_control
+
+    @type enabled: bool
+    @param enabled: use the asyncio engine once the browser has solved the challenge
+    @type concurrency: int
+    @param concurrency: connections kept open over all hosts
+    """
+
+    global use_async_fetch, async_concurrency
+    use_async_fetch = enabled
+    async_concurrency = concurrency
+
+    if not enabled:
+        return
+    import async_fetch
+    if not async_fetch.available():
+        print("configure_async_fetch: aiohttp is not installed, pages will be fetched with threads")
+
+
+def async_fetcher():
+    """
+    AsyncFetcher carrying the clearance cookies and user agent of scraper, None while the
+    asyncio engine cannot be used (disabled, aiohttp missing or no clearance yet)
+    """
+
+    if offline or not (use_async_fetch and use_http_fetch and clearance_ready):
+        return None
+    import async_fetch
+    if not async_fetch.available():
+        return None
+
+    with clearance_lock:
+        cookies = [(c.name, c.value, c.domain, c.path) for c in get_scraper().cookies]
+        headers = {'User-Agent': get_scraper().headers['User-Agent']}
+
+    return async_fetch.AsyncFetcher(fetch_control, http_cache, headers, cookies, async_concurrency,
+                                    is_challenge=is_challenge_page)
+
+
+def evict_http_cache():
+    """
+    Trim the on-disk cache to its TTL and size limits, call once at the end of a run
+    """
+
+    if http_cache is not None:
+        http_cache.evict()
+
+
+def configure_illustrations(embed=True, workers=4, max_size=None, quality=85):
+    """
+    Set whether and how the images of the '插图' chapter are embedded in the book
+
+    @type embed: bool
+    @param embed: embed every illustration instead of only using one as the cover
+    @type workers: int
+    @param workers: number of illustrations downloaded in parallel
+    @type max_size: int
+    @param max_size: longest side in pixels to downscale to, None keeps the original images
+    @type quality: int
+    @param quality: JPEG quality of downscaled images
+    """
+
+    global embed_illustrations, illustration_workers, illustration_max_size, illustration_quality
+    embed_illustrations = embed
+    illustration_workers = workers
+    illustration_max_size = max_size
+    illustration_quality = quality
+
+    if embed and max_size is not None and not PILLOW_AVAILABLE:
+        print("configure_illustrations: Pillow is not installed, illustrations will not be downscaled")
+
+
+def configure_memory_path(budget=256 * 1024 * 1024):
+    """
+    Keep chapter files in memory between download, cleaning and packing instead of writing them to '../temp'
+    Chapters beyond the budget are written to their files as before. Chapter pages are saved once, to the
+    chapter store, an interrupted run resumes from the pages stored within the download cache TTL
+
+    @type budget: int
+    @param budget: bytes of chapters kept in memory at once, None or 0 writes every chapter to disk
+    """
+
+    global chapter_buffers
+    chapter_buffers = ChapterBuffers(budget) if budget else None
+
+
+def cache_page(page_type):
+    """
+    Check if a downloaded page goes to the download cache. In memory mode chapter pages are only
+    saved to the chapter store, fetch_volume resumes from there, see restore_chapter
+
+    @type page_type: str
+    @param page_type: 'index', 'chapter' or 'illustrations'
+    """
+
+    return http_cache is not None and (page_type == 'index' or chapter_buffers is None or chapter_store is None)
+
+
+def write_chapter(chapter_file, text):
+    """
+    Save a chapter page, in memory when the memory path is on, to chapter_file otherwise
+
+    @type chapter_file: str
+    @param chapter_file: file name of the chapter
+    @type text: str
+    @param text: page source or cleaned XHTML
+    """
+
+    if chapter_buffers is not None:
+        chapter_buffers.write(chapter_file, text.encode('utf-8-sig'))
+        return
+
+    with open(chapter_file, 'w', encoding='utf-8-sig') as f:
+        f.write(text)
+
+
+def read_chapter(chapter_file):
+    """
+    Text of a chapter saved by write_chapter, with line endings read the same way open() reads them
+
+    @type chapter_file: str
+    @param chapter_file: file name of the chapter
+    """
+
+    if chapter_buffers is not None:
+        text = chapter_buffers.read(chapter_file).decode('utf-8-sig')
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    with open(chapter_file, 'r', encoding='utf-8-sig') as f:
+        return f.read()
+
+
+def chapter_content(chapter_file):
+    """
+    What compress_epub packs for a chapter: its bytes if it is in memory, its file name otherwise
+
+    @type chapter_file: str
+    @param chapter_file: file name of the chapter
+    """
+
+    return chapter_buffers.content(chapter_file) if chapter_buffers is not None else chapter_file
+
+
+def remove_chapter(chapter_file):
+    if chapter_buffers is not None:
+        chapter_buffers.remove(chapter_file)
+    else:
+        os.remove(chapter_file)
+
+
+def release_chapters(temp_dir):
+    """
+    Free the in-memory chapters of a volume once its epub is written
+
+    @type temp_dir: str
+    @param temp_dir: folder the chapters of the volume were saved to
+    """
+
+    if chapter_buffers is not None:
+        chapter_buffers.release(temp_dir)
+
+
+def close_chapter_store():
+    """
+    Close the chapter store database, call once at the end of a run
+    """
+
+    if chapter_store is not None:
+        chapter_store.close()
+
+
+def close_browser_pool():
+    """
+    Quit all browser sessions, call once at the end of a run
+    """
+
+    if browser_pool is not None:
+        browser_pool.close()
+
+
+def create_temp_dir(temp_dir="../temp", keep_temp=False):
+    """
+    Create the temporary directory of a job, if it already exists, then it will be removed
+    Each book has its own folder under '../temp', so a run never deletes the files another book resumes from
+
+    @type temp_dir: str
+    @param temp_dir: folder of the job, e.g. '../temp/<journal key>'
+    @type keep_temp: bool
+    @param keep_temp: keep files already in temp_dir, used when resuming an interrupted job
+    """
+
+    if keep_temp and os.path.exists(temp_dir):
+        print("create_temp_dir: Directory '%s' kept" % temp_dir)
+        return
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    print("create_temp_dir: Directory '%s' created" % temp_dir)
+
+
+def delete_temp_dir(temp_dir="../temp"):
+    """
+    Permanently delete the temporary directory of a job
+
+    @type temp_dir: str
+    @param temp_dir: folder created by create_temp_dir
+    """
+
+    # Chapters still held in memory belong to the temp folder too
+    if chapter_buffers is not None:
+        chapter_buffers.release(temp_dir)
+
+    shutil.rmtree(temp_dir, ignore_errors=False, onerror=None)
+    print("delete_temp_dir: Directory '%s' deleted" % temp_dir)
+
+
+def scrape_book(volume, cover_file, workers=1, journal=None, temp_dir="../temp", cover_policy=None,
+                cached_chapters=None):
     """
     Scrape book content from https://www.wenku8.net/ (chapter html and cover image)
+    Returns (chapter, file name) pairs in reading order, without the '插图' chapter
 
-    @type volume_name: str
-    @param volume_name: Novel name of this volume
-    @type chapter_list: dict
-    @param chapter_list: chapter names and URLs
+    @type volume: catalog.Volume
+    @param volume: volume to download
     @type cover_file: str
-    @param chapter_list: default file location and name for cover image ''../temp/cover.jpg''
+    @param cover_file: default file location and name for cover image ''../temp/cover.jpg''
+    @type workers: int
+    @param workers: number of chapters downloaded in parallel, 1 downloads them one by one
+    @type journal: journal.Journal
+    @param journal: checkpoint journal, steps already recorded in it are skipped
+    @type temp_dir: str
+    @param temp_dir: folder the chapters of this volume are downloaded to
+    @type cover_policy: str or int
+    @param cover_policy: how to pick the cover without asking, see pick_cover, None asks the user
+    @type cached_chapters: set
+    @param cached_chapters: ids of chapters unchanged since the last run, read from the cache if possible
     """
 
-    print("scape_book: Start web scraping from Wenku for book '%s' ..." % volume_name)
+    chapter_files = fetch_volume(volume, cover_file, workers, journal, temp_dir, cover_policy, cached_chapters)
+    clean_volume(volume.name, chapter_files, journal)
 
-    # Download all chapters
-    for chapter_name, chapter_url in chapter_list.items():
-        chapter_file = '../temp/' + chapter_name + '.html'
-        download_html(chapter_url, chapter_file)
+    return chapter_files
 
-        # Update chapter_list value with filename instead of url
-        chapter_list[chapter_name] = chapter_file
 
-    # Check if '插图' chapter exists
-    if '插图' in chapter_list:
-        print("scrape_book: Found '插图' chapter!")
+def fetch_volume(volume, cover_file, workers=1, journal=None, temp_dir="../temp", cover_policy=None,
+                 cached_chapters=None, on_chapter=None):
+    """
+    Download the chapters and cover image of a volume, first stage of scrape_book
+    Returns (chapter, file name) pairs in reading order, the '插图' chapter is only kept
+    (rewritten to show the downloaded images) when embed_illustrations is set
 
-        # Get all image URLs from '插图' chapter
-        image_url = extract_images(chapter_list['插图'])
+    @type volume: catalog.Volume
+    @param volume: volume to download
+    @type cover_file: str
+    @param cover_file: file location and name for the cover image
+    @type workers: int
+    @param workers: number of chapters downloaded in parallel, 1 downloads them one by one
+    @type journal: journal.Journal
+    @param journal: checkpoint journal, steps already recorded in it are skipped
+    @type temp_dir: str
+    @param temp_dir: folder the chapters of this volume are downloaded to
+    @type cover_policy: str or int
+    @param cover_policy: how to pick the cover without asking, see pick_cover, None asks the user
+    @type cached_chapters: set
+    @param cached_chapters: ids of chapters unchanged since the last run, read from the cache if possible
+    @type on_chapter: function
+    @param on_chapter: called with (chapter, file name) as soon as each chapter is saved, see write_chapter
+    """
 
-        # Ask user to choose a cover image for the book
-        cover_url = choose_cover(image_url)
+    print("scape_book: Start web scraping from Wenku for book '%s' ..." % volume.name)
+
+    def is_done(stage, item=None):
+        return journal is not None and journal.is_done(volume.name, stage, item)
+
+    def page_type(chapter):
+        return 'illustrations' if chapter.title == '插图' else 'chapter'
+
+    def max_age(chapter):
+        # Chapters known to be unchanged since the last run are taken from the cache without asking the server
+        return float('inf') if cached_chapters and chapter.chapter_id in cached_chapters else None
+
+    def downloaded(chapter, chapter_file, page=None):
+        if page is not None and chapter_store is not None:
+            chapter_store.put_raw(book, volume.name, chapter, page)
+        # In-memory chapters are lost if the run is interrupted, only files on disk count as done
+        if journal is not None and chapter_buffers is None:
+            journal.mark(volume.name, 'download', chapter.chapter_id)
+        if on_chapter is not None:
+            on_chapter(chapter, chapter_file)
+
+    def is_downloaded(chapter, chapter_file):
+        # A journal entry only counts while its file is still there, the file may have been deleted
+        # with the temp folder, its clean entry then refers to a file that is gone as well
+        if not is_done('download', chapter.chapter_id):
+            return False
+        # The '插图' page is deleted once its image links are read unless illustrations are embedded
+        if os.path.exists(chapter_file) or (chapter.title == '插图' and not embed_illustrations):
+            return True
+        print("scrape_book: '%s' is in the journal but its file is gone, downloading it again" % chapter.title)
+        journal.undo(volume.name, 'download', chapter.chapter_id)
+        journal.undo(volume.name, 'clean', chapter.chapter_id)
+        if chapter.title == '插图':
+            journal.undo(volume.name, 'illustrations')
+        return False
+
+    def stored_is_fresh(chapter, entry):
+        # In memory mode the store holds the only copy of a page, it stands in for the download cache
+        return not cache_page(page_type(chapter)) and http_cache is not None and entry['fetched_at'] is not None \
+            and time.time() - entry['fetched_at'] < http_cache.ttl
+
+    def restore_chapter(chapter, chapter_file):
+        # Stored pages replace the download when offline, when the index says the chapter did not change
+        # or, in memory mode, when the page was fetched recently, e.g. by an interrupted run
+        entry = stored.get(chapter.chapter_id)
+        if entry is None or entry['raw'] is None or is_downloaded(chapter, chapter_file):
+            return False
+        if not offline and max_age(chapter) != float('inf') and not stored_is_fresh(chapter, entry):
+            return False
+        write_chapter(chapter_file, entry['raw'])
+        downloaded(chapter, chapter_file)
+        return True
 
+    def download_chapter(chapter, chapter_file):
+        if is_downloaded(chapter, chapter_file):
+            print("scrape_book: '%s' already downloaded, skipping" % chapter.title)
+            if on_chapter is not None:
+                on_chapter(chapter, chapter_file)
+            return
+        page = fetch_page(chapter.url, max_age=max_age(chapter), page_type=page_type(chapter))
+        if page is None:
+            raise RuntimeError("scrape_book: Failed to download chapter '%s'" % chapter.title)
+        write_chapter(chapter_file, page)
+        downloaded(chapter, chapter_file, page)
+
+    os.makedirs(temp_dir, exist_ok=True)
+
+    # Files are named by chapter id, chapter titles are not unique
+    chapter_files = [(chapter, temp_dir + '/' + chapter.chapter_id + '.html') for chapter in volume.chapters]
+
+    # Every stored chapter of the volume in one read
+    book = book_id(volume.chapters[0].url) if volume.chapters else None
+    stored = chapter_store.volume_chapters(book, volume.name) if chapter_store is not None and book else {}
+    remaining = [(chapter, chapter_file) for chapter, chapter_file in chapter_files
+                 if not restore_chapter(chapter, chapter_file)]
+    if len(remaining) < len(chapter_files):
+        print("scrape_book: %d chapters restored from the chapter store" % (len(chapter_files) - len(remaining)))
+
+    # All chapters in flight at once on the asyncio engine, pages it cannot get go through download_html
+    fetcher = async_fetcher()
+    if fetcher is not None:
+        done = [(chapter, chapter_file) for chapter, chapter_file in remaining
+                if is_downloaded(chapter, chapter_file)]
+        remaining = download_chapters_async(fetcher, [(chapter, chapter_file, max_age(chapter))
+                                                      for chapter, chapter_file in remaining
+                                                      if not is_done('download', chapter.chapter_id)],
+                                            downloaded)
+        remaining += done
+
+    # Download the remaining chapters with threads
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(download_chapter, [chapter for chapter, _ in remaining],
+                          [chapter_file for _, chapter_file in remaining]))
+
+    image_pages = [chapter_file for chapter, chapter_file in chapter_files if chapter.title == '插图']
+    image_url = None
+
+    # Downloaded illustrations are only kept in the temp folder, download the recorded URLs again if it was deleted
+    if is_done('illustrations') and embed_illustrations and not os.path.isdir(temp_dir + '/images'):
+        image_url = journal.data(volume.name, 'illustrations')['urls']
+        journal.undo(volume.name, 'illustrations')
+
+    def get_image_url():
+        # Image URLs of the '插图' chapter, read once, the page is rewritten when illustrations are embedded
+        nonlocal image_url
+        if image_url is None:
+            if is_done('illustrations'):
+                image_url = journal.data(volume.name, 'illustrations')['urls']
+            elif image_pages:
+                image_url = extract_images(image_pages[0], delete=not embed_illustrations)
+            else:
+                image_url = []
+        return image_url
+
+    if embed_illustrations and image_pages and not is_done('illustrations'):
+        image_hrefs = download_illustrations(get_image_url(), temp_dir + '/images')
+        write_illustration_page(image_pages[0], '插图', image_hrefs)
+        if journal is not None and chapter_buffers is None:
+            journal.mark(volume.name, 'illustrations', urls=image_url)
+
+    if not embed_illustrations:
         # Remove '插图' chapter from the list of chapters
-        del chapter_list['插图']
+        chapter_files = [(chapter, chapter_file) for chapter, chapter_file in chapter_files
+                         if chapter.title != '插图']
 
+    if is_done('cover') and not os.path.exists(cover_file):
+        # Download the recorded cover again, its file was deleted with the temp folder
+        volume.cover_url = journal.data(volume.name, 'cover')['url']
+        journal.undo(volume.name, 'cover')
+
+    if is_done('cover'):
+        print("scrape_book: Cover already downloaded, skipping")
+        volume.cover_url = journal.data(volume.name, 'cover')['url']
     else:
-        # Ask user to manually enter URL to the cover image
-        cover_url = get_cover()
+        # Check if '插图' chapter exists
+        if volume.cover_url is not None:
+            # Same cover as the run that saved the catalog, e.g. when rebuilding from the cache
+            cover_url = volume.cover_url
+
+        elif cover_policy is not None:
+            # Non-interactive run
+            cover_url = pick_cover(get_image_url(), cover_policy,
+                                   index_cover_url(volume.chapters[0].url) if volume.chapters else None)
+
+        elif image_pages:
+            print("scrape_book: Found '插图' chapter!")
+
+            # Get all image URLs from '插图' chapter
+            # Ask user to choose a cover image for the book
+            cover_url = choose_cover(get_image_url())
+
+        else:
+            # Ask user to manually enter URL to the cover image
+            cover_url = get_cover()
+
+        # Download image at specified URL
+        if download_image(cover_url, cover_file) is None:
+            raise RuntimeError("scrape_book: Failed to download cover image")
+        if journal is not None:
+            journal.mark(volume.name, 'cover', url=cover_url)
+        volume.cover_url = cover_url
+
+    return chapter_files
+
+
+def clean_volume(volume_name, chapter_files, journal=None):
+    """
+    Clean up every downloaded chapter of a volume, second stage of scrape_book
 
-    # Download image at specified URL
-    download_image(cover_url, cover_file)
+    @type volume_name: str
+    @param volume_name: Novel name of this volume
+    @type chapter_files: list
+    @param chapter_files: (chapter, file name) pairs returned by fetch_volume
+    @type journal: journal.Journal
+    @param journal: checkpoint journal, chapters already recorded in it are skipped
+    """
 
     # Clean up each chapter
-    for chapter_name, chapter_file in chapter_list.items():
-        clean_chapter(chapter_file, chapter_name)
+    for chapter, chapter_file in chapter_files:
+        clean_downloaded(volume_name, chapter, chapter_file, journal)
+
+    return chapter_files
+
+
+def clean_downloaded(volume_name, chapter, chapter_file, journal=None):
+    """
+    Clean up one downloaded chapter unless the journal says it is already done
+    The '插图' page is skipped, it is written by write_illustration_page
+
+    @type volume_name: str
+    @param volume_name: Novel name of this volume
+    @type chapter: catalog.Chapter
+    @param chapter: chapter of the file
+    @type chapter_file: str
+    @param chapter_file: file returned by fetch_volume
+    @type journal: journal.Journal
+    @param journal: checkpoint journal
+    """
+
+    if chapter.title == '插图':
+        return
+    if journal is not None and journal.is_done(volume_name, 'clean', chapter.chapter_id):
+        return
+
+    # The chapter store keeps the cleaned text of every page it has seen, cleaning is only redone
+    # for new or changed pages and after CLEANER_VERSION changed
+    book = book_id(chapter.url)
+    xhtml = chapter_store.cleaned(book, volume_name, chapter.chapter_id, CLEANER_VERSION) \
+        if chapter_store is not None else None
+    if xhtml is not None:
+        write_chapter(chapter_file, xhtml)
+    else:
+        xhtml = clean_chapter(chapter_file, chapter.title)
+        if chapter_store is not None:
+            chapter_store.put_cleaned(book, volume_name, chapter.chapter_id, xhtml, CLEANER_VERSION)
+
+    if journal is not None and chapter_buffers is None:
+        journal.mark(volume_name, 'clean', chapter.chapter_id)
+
+
+def wait_for_page(driver, ready_selector, timeout=30):
+    """
+    Wait until the Cloudflare challenge is gone and the expected element is present
+
+    @type driver: webdriver.Chrome
+    @param driver: browser session that has started loading the page
+    @type ready_selector: str
+    @param ready_selector: CSS selector of an element that only exists on the real page
+    @type timeout: float
+    @param timeout: maximum seconds to wait before TimeoutException is raised
+    """
+
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    def page_ready(d):
+        if any(t in d.title for t in CHALLENGE_TITLES):
+            return False
+        if d.find_elements(By.CSS_SELECTOR, CHALLENGE_SELECTORS):
+            return False
+        return len(d.find_elements(By.CSS_SELECTOR, ready_selector)) > 0
+
+    start = time.monotonic()
+    WebDriverWait(driver, timeout, poll_frequency=0.2).until(page_ready)
+    return time.monotonic() - start
+
+
+def is_challenge_page(html):
+    """
+    Check if an HTML page is a Cloudflare challenge instead of the real content
+
+    @type html: str
+    @param html: raw page source
+    """
+
+    return any(marker in html for marker in CHALLENGE_MARKERS)
+
+
+def sync_clearance(driver):
+    """
+    Copy the Cloudflare clearance cookies and user agent of a browser session into scraper
+
+    @type driver: webdriver.Chrome
+    @param driver: browser session that has passed the challenge
+    """
+
+    global clearance_ready
+
+    cookies = driver.get_cookies()
+    user_agent = driver.execute_script("return navigator.userAgent")
+
+    session = get_scraper()
+    with clearance_lock:
+        for cookie in cookies:
+            session.cookies.set(cookie['name'], cookie['value'],
+                                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        # cf_clearance is only valid together with the user agent that solved the challenge
+        session.headers['User-Agent'] = user_agent
+
+        if not clearance_ready:
+            print("sync_clearance: Browser clearance copied to HTTP session")
+        clearance_ready = True
+
+
+def fetch_html_http(html_url, page_type='chapter'):
+    """
+    Fetch a page over the cloudscraper session, returns None if Cloudflare serves a challenge
+    A stale cached copy is revalidated with a conditional request when the server sent validators
+
+    @type html_url: str
+    @param html_url: url of the page
+    @type page_type: str
+    @param page_type: 'index', 'chapter' or 'illustrations', see cache_page
+    """
+
+    cached = http_cache.get(html_url) if http_cache is not None else None
+    headers = HttpCache.validators(cached[1]) if cached else {}
+
+    with fetch_control.slot(html_url):
+        response = get_scraper().get(html_url, headers=headers, timeout=30)
+
+    if response.status_code == 304 and cached:
+        print("download_html: Cached copy of %s not modified" % html_url)
+        fetch_control.check_response(html_url, response)
+        http_cache.refresh(html_url, cached[1])
+        return cached[0].decode('utf-8')
+
+    if response.status_code == 403 or is_challenge_page(response.text):
+        return None
+    # 429 and 503 without a challenge mean we are going too fast
+    fetch_control.check_response(html_url, response)
+    response.raise_for_status()
+
+    # wenku8 pages are GBK encoded, do not fall back to requests' ISO-8859-1 default
+    if 'charset' not in response.headers.get('content-type', '').lower():
+        response.encoding = response.apparent_encoding
+
+    page = response.text
+    if cache_page(page_type):
+        http_cache.store(html_url, page.encode('utf-8'), response.headers)
+
+    return page
 
-    return chapter_list
 
+def fetch_html_browser(html_url, ready_selector, timeout, page_type='chapter'):
+    """
+    Fetch a page with a pooled browser and share its clearance with the HTTP session
+    Returns (page source, seconds spent waiting for the challenge and the page)
+
+    @type html_url: str
+    @param html_url: url of the page
+    @type ready_selector: str
+    @param ready_selector: CSS selector that marks the page as loaded
+    @type timeout: float
+    @param timeout: maximum seconds to wait for the page to become ready
+    @type page_type: str
+    @param page_type: 'index', 'chapter' or 'illustrations', selects the profile in browser_profiles
+    """
+
+    # Borrow a warm browser from the pool instead of starting a new one
+    profile = browser_profiles.get(page_type, 'full')
+    with fetch_control.slot(html_url), get_browser_pool().session(profile=profile) as driver:
+        driver.get(html_url)
+
+        # Wait for Cloudflare "Checking your browser" page to finish
+        waited = wait_for_page(driver, ready_selector, timeout)
+        print("download_html: Page ready after %.2f seconds" % waited)
 
+        if use_http_fetch:
+            sync_clearance(driver)
 
+        # Retrieve HTML
+        page = driver.page_source
 
+    if cache_page(page_type):
+        http_cache.store(html_url, page.encode('utf-8'))
 
-def download_html(html_url, html_file):
+    return page, waited
+
+
+def download_html(html_url, html_file, ready_selector=CHAPTER_READY, timeout=30, max_age=None, page_type=None):
     """
-    Downloads a page using Selenium (works even when Cloudscraper/requests are blocked)
+    Downloads a page over plain HTTP once Cloudflare clearance is known, otherwise (or when a
+    challenge comes back) uses a pooled Selenium browser (works even when Cloudscraper/requests are blocked)
     Saves the resulting HTML to html_file.
+
+    @type ready_selector: str
+    @param ready_selector: CSS selector that marks the page as loaded, CHAPTER_READY or INDEX_READY
+    @type timeout: float
+    @param timeout: maximum seconds to wait for the page to become ready
+    @type max_age: float
+    @param max_age: seconds a cached copy is used without asking the server, None uses the cache TTL
+    @type page_type: str
+    @param page_type: 'index', 'chapter' or 'illustrations', None guesses it from ready_selector
+    """
+
+    page = fetch_page(html_url, ready_selector, timeout, max_age, page_type)
+    if page is None:
+        return None
+
+    # Write to file
+    with open(html_file, "w", encoding="utf-8-sig") as f:
+        f.write(page)
+
+    print("download_html: Finish writing to %s" % html_file)
+    return html_file
+
+
+def fetch_page(html_url, ready_selector=CHAPTER_READY, timeout=30, max_age=None, page_type=None):
+    """
+    Same as download_html, but returns the page source instead of writing it, None if it failed
+
+    @type html_url: str
+    @param html_url: url of the page
+    @type ready_selector: str
+    @param ready_selector: CSS selector that marks the page as loaded, CHAPTER_READY or INDEX_READY
+    @type timeout: float
+    @param timeout: maximum seconds to wait for the page to become ready
+    @type max_age: float
+    @param max_age: seconds a cached copy is used without asking the server, None uses the cache TTL
+    @type page_type: str
+    @param page_type: 'index', 'chapter' or 'illustrations', None guesses it from ready_selector
     """
 
     print("download_html: Fetching %s ..." % html_url)
 
-    max_retries = 5
-    base_retry_interval = 2
+    if page_type is None:
+        page_type = 'index' if ready_selector == INDEX_READY else 'chapter'
+
+    with metrics.timer('download_html', html_url) as sample:
+        # Fresh copy in the on-disk cache, no request needed
+        cached = http_cache.get(html_url) if http_cache is not None else None
+        if cached and (offline or http_cache.is_fresh(cached[1], max_age)):
+            print("download_html: Using cached copy")
+            sample.update(source='cache', bytes=len(cached[0]))
+            return cached[0].decode('utf-8')
+
+        if offline:
+            print("download_html: %s is not in the cache and network access is off. Failed." % html_url)
+            sample['ok'] = False
+            return None
+
+        from selenium.common.exceptions import WebDriverException, TimeoutException
+
+        max_retries = 5
+        retries = 0
+
+        while retries < max_retries:
+            retry_after = None
+            try:
+                page = None
+
+                # Cheap path: a single request with the browser's clearance cookies
+                if use_http_fetch and clearance_ready:
+                    page = fetch_html_http(html_url, page_type)
+                    if page is None:
+                        print("download_html: Challenge page detected, falling back to browser ...")
+
+                if page is None:
+                    page, waited = fetch_html_browser(html_url, ready_selector, timeout, page_type)
+                    sample['challenge_wait'] = sample.get('challenge_wait', 0) + waited
+                    sample['source'] = 'browser'
+                    sample['profile'] = browser_profiles.get(page_type, 'full')
+                else:
+                    sample['source'] = 'http'
+
+                sample.update(bytes=len(page.encode('utf-8')), retries=retries)
+                return page
+
+            except ThrottledError as e:
+                print(f"download_html: Throttled, {e}")
+                retry_after = e.retry_after
+            except TimeoutException:
+                print(f"download_html: Page not ready after {timeout} seconds")
+            except WebDriverException as e:
+                print(f"download_html: WebDriver error: {e}")
+            except Exception as e:
+                print(f"download_html: Error occurred: {e}")
+
+            # Jittered so concurrent downloads do not retry in lockstep
+            retry_interval = fetch_control.backoff(retries, retry_after)
+            retries += 1
+            print(f"download_html: Retry {retries}/{max_retries} in {retry_interval:.1f} seconds...")
+            time.sleep(retry_interval)
+
+        print("download_html: Maximum retries reached. Failed.")
+        sample.update(ok=False, retries=retries)
+        return None
+
+
+def download_chapters_async(fetcher, chapters, on_chapter):
+    """
+    Fetch many chapters at once on the asyncio engine, each page is saved and handed to
+    on_chapter as soon as it arrives
+    Returns the (chapter, file name) pairs it could not get, e.g. because Cloudflare served a challenge
+
+    @type fetcher: async_fetch.AsyncFetcher
+    @param fetcher: engine returned by async_fetcher()
+    @type chapters: list
+    @param chapters: (chapter, file name, max_age) tuples, see download_html for max_age
+    @type on_chapter: function
+    @param on_chapter: called with (chapter, file name, page source) for every saved page
+    """
 
-    retries = 0
-    retry_interval = base_retry_interval
+    print("download_chapters_async: Fetching %d chapters ..." % len(chapters))
 
-    # --- Selenium setup ---
-    options = Options()
-    options.add_argument("--headless=new")   # Try headless, fallback if Cloudflare blocks it
-    options.add_argument("--disable-blink-features=AutomationControlled")
-    options.add_argument("start-maximized")
+    files = {chapter.chapter_id: chapter_file for chapter, chapter_file, _ in chapters}
+    failed = []
 
-    while retries < max_retries:
-        try:
-            driver = webdriver.Chrome(options=options)
+    def saved(chapter, page, error):
+        chapter_file = files[chapter.chapter_id]
+        if page is None:
+            print("download_chapters_async: No page for '%s' (%s), retrying with download_html"
+                  % (chapter.title, error or "challenge"))
+            failed.append((chapter, chapter_file))
+            return
+
+        write_chapter(chapter_file, page)
+        on_chapter(chapter, chapter_file, page)
 
-            driver.get(html_url)
+    fetcher.fetch_all([(chapter, fetcher.fetch_page, chapter.url, max_age, cache_page('chapter'))
+                       for chapter, _, max_age in chapters], saved)
 
-            # Wait for Cloudflare "Checking your browser" page to finish
-            time.sleep(5)
+    print("download_chapters_async: %d of %d chapters saved" % (len(chapters) - len(failed), len(chapters)))
+    return failed
 
-            # Retrieve HTML
-            page = driver.page_source
-            driver.quit()
 
-            # Write to file
-            with open(html_file, "w", encoding="utf-8-sig") as f:
-                f.write(page)
+def index_cover_url(url):
+    """
+    Cover of the whole book wenku8 shows next to its index, e.g. 'https://img.wenku8.com/image/1/1234/1234s.jpg'
+    for 'https://www.wenku8.net/novel/1/1234/index.htm' or '.../novel/1/1234/5678.htm'
 
-            print("download_html: Finish writing to %s" % html_file)
-            return html_file
+    @type url: str
+    @param url: url of the index page or of a chapter
+    """
 
-        except WebDriverException as e:
-            print(f"download_html: WebDriver error: {e}")
-        except Exception as e:
-            print(f"download_html: Error occurred: {e}")
+    folder = posixpath.dirname(urlparse(url).path)
+    book = posixpath.basename(folder)
+    return INDEX_COVER_URL % (posixpath.basename(posixpath.dirname(folder)), book, book)
 
-        retries += 1
-        print(f"download_html: Retry {retries}/{max_retries} in {retry_interval} seconds...")
-        time.sleep(retry_interval)
-        retry_interval *= 2
 
-    print("download_html: Maximum retries reached. Failed.")
-    return None
+def pick_cover(image_url, cover_policy, fallback=None):
+    """
+    Choose the cover without asking the user
+
+    @type image_url: list
+    @param image_url: image URLs found in the '插图' chapter, empty if there is none
+    @type cover_policy: str or int
+    @param cover_policy: 'first' for the first illustration, an index into image_url or the URL of an image
+    @type fallback: str
+    @param fallback: cover used when there is no '插图' chapter, usually index_cover_url() of the book
+    """
+
+    import validators
 
+    if isinstance(cover_policy, str) and validators.url(cover_policy):
+        return cover_policy
+
+    if not image_url:
+        if fallback is None:
+            raise ValueError("pick_cover: No '插图' chapter found, cover policy must be an image URL")
+        print("pick_cover: No '插图' chapter found, using the cover of the index page")
+        return fallback
+
+    index = 0 if cover_policy == 'first' else int(cover_policy)
+    if index not in range(len(image_url)):
+        raise ValueError("pick_cover: Cover index %d out of range, %d images found" % (index, len(image_url)))
+
+    return image_url[index]
 
 
 def choose_cover(image_url):
@@ -180,6 +1027,8 @@ def get_cover():
     Ask user to manually enter url to the cover image
     """
 
+    import validators
+
     print("get_cover: Cannot find '插图' chapter, please manually enter the URL to cover image")
 
     cover_url = input("URL to cover image: ")
@@ -196,6 +1045,8 @@ def get_index_url():
     Ask user to enter url to the index page of the book
     """
 
+    import validators
+
     index_url = input("get_index_url: Please enter URL of the index page of the book:")
 
     while not validators.url(index_url):
@@ -205,6 +1056,80 @@ def get_index_url():
     return index_url
 
 
+def fetch_cached(url, headers):
+    """
+    GET a url through the on-disk cache, revalidating stale entries when possible
+    Returns (content, content type), content is None if the request failed
+
+    @type url: str
+    @param url: url to fetch
+    @type headers: dict
+    @param headers: request headers
+    """
+
+    # Covers and illustrations never change, a stored copy is used as it is
+    stored = chapter_store.image(url) if chapter_store is not None else None
+    if stored is not None:
+        return stored
+
+    cached = http_cache.get(url) if http_cache is not None else None
+    if cached and (offline or http_cache.is_fresh(cached[1])):
+        if chapter_store is not None:
+            chapter_store.put_image(url, cached[0], cached[1].get('content_type'))
+        return cached[0], cached[1].get('content_type')
+
+    if offline:
+        print("fetch_cached: %s is not in the cache and network access is off" % url)
+        return None, None
+
+    request_headers = dict(headers)
+    if cached:
+        request_headers.update(HttpCache.validators(cached[1]))
+
+    import requests  # installed with cloudscraper
+
+    max_retries = 5
+    for retries in range(max_retries):
+        retry_after = None
+        try:
+            with fetch_control.slot(url):
+                response = get_scraper().get(url, headers=request_headers, timeout=30)
+            fetch_control.check_response(url, response)
+            break
+        except ThrottledError as e:
+            print("fetch_cached: Throttled, %s" % e)
+            retry_after = e.retry_after
+        except requests.RequestException as e:
+            # Connection errors and timeouts, e.g. a DNS failure on the image host
+            print("fetch_cached: %s failed: %s" % (url, e))
+            response = None
+
+        if retries == max_retries - 1:
+            break
+        retry_interval = fetch_control.backoff(retries, retry_after)
+        print("fetch_cached: Retry in %.1f seconds..." % retry_interval)
+        time.sleep(retry_interval)
+
+    if response is None:
+        print("fetch_cached: Maximum retries reached for %s" % url)
+        return None, None
+
+    if response.status_code == 304 and cached:
+        http_cache.refresh(url, cached[1])
+        return cached[0], cached[1].get('content_type')
+
+    if not response.ok:
+        print('fetch_cached: ', response)
+        return None, None
+
+    if http_cache is not None:
+        http_cache.store(url, response.content, response.headers)
+    if chapter_store is not None:
+        chapter_store.put_image(url, response.content, response.headers.get('content-type'))
+
+    return response.content, response.headers.get('content-type')
+
+
 def is_url_image(image_url):
     """
     Check if url leads to an image
@@ -219,9 +1144,18 @@ def is_url_image(image_url):
                       'Safari/537.36'}
 
     image_formats = ("image/png", "image/jpeg", "image/jpg")
-    r = scraper.head(image_url, headers=headers)
-    if r.headers["content-type"] in image_formats:
-        print("is_url_image: Success! Entered URL leads to a " + r.headers["content-type"])
+
+    # A cached copy already knows its content type
+    cached = http_cache.get(image_url) if http_cache is not None else None
+    if cached and cached[1].get('content_type'):
+        content_type = cached[1]['content_type']
+    else:
+        with fetch_control.slot(image_url):
+            r = get_scraper().head(image_url, headers=headers, timeout=30)
+        content_type = r.headers["content-type"]
+
+    if content_type in image_formats:
+        print("is_url_image: Success! Entered URL leads to a " + content_type)
         return True
     else:
         print("is_url_image: Entered URL does not lead to an image!")
@@ -230,7 +1164,7 @@ def is_url_image(image_url):
 
 def download_image(image_url, image_file):
     """
-    Fetch image from a URL link and save to local disk
+    Fetch image from a URL link (or the on-disk cache) and save to local disk
 
     @type image_url: str
     @param image_url: url of image to be used as cover
@@ -245,33 +1179,52 @@ def download_image(image_url, image_file):
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 '
                       'Safari/537.36'}
 
-    response = scraper.get(image_url, headers=headers)
-    if response.ok:
-        img_data = response.content
+    with metrics.timer('download_image', image_url) as sample:
+        img_data, _ = fetch_cached(image_url, headers)
+        if img_data is None:
+            sample['ok'] = False
+            return None
+
         with open(image_file, 'wb') as handler:
             handler.write(img_data)
-    else:
-        print('download_image: ', response)
+        sample['bytes'] = len(img_data)
 
     print("download_image: Successfully downloaded cover image!")
+    return image_file
 
 
-def extract_images(image_page):
+def parse_html(markup, parse_only=None, parser=None):
+    """
+    Build a BeautifulSoup tree, with lxml when it is installed
+
+    @type markup: str
+    @param markup: HTML source or an open file
+    @type parse_only: dict
+    @param parse_only: SoupStrainer arguments, only matching elements are built into the tree, None builds the whole page
+    @type parser: str
+    @param parser: 'lxml' or 'html.parser', None uses HTML_PARSER
+    """
+
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    strainer = SoupStrainer(**parse_only) if parse_only is not None else None
+    return BeautifulSoup(markup, parser or HTML_PARSER, parse_only=strainer)
+
+
+def extract_images(image_page, delete=True):
     """
     Extract all image URLs from the '插图' chapter
 
     @type image_page: str
     @param image_page: html file name containing the '插图' chapter
+    @type delete: bool
+    @param delete: delete the '插图' chapter afterwards, it is kept when illustrations are embedded
     """
 
     print("extract_images: Extracting image URLs from '插图' chapter...")
 
-    # Open file in read mode 'r'
-    raw = open(image_page, 'r', encoding='utf-8-sig')
-
-    # Create Beautiful soup object
-    # html.parser is the built-in parser
-    soup = BeautifulSoup(raw, 'html.parser')
+    # Create Beautiful soup object, only the img tags are needed
+    soup = parse_html(read_chapter(image_page), IMAGE_STRAINER)
 
     image_url = []
 
@@ -282,20 +1235,143 @@ def extract_images(image_page):
         link = img.get('src')
         image_url.append(link)
 
-    raw.close()
-    os.remove(image_page)
-    print("extract_images: Deleting '插图' chapter...")
+    if delete:
+        remove_chapter(image_page)
+        print("extract_images: Deleting '插图' chapter...")
     return image_url
 
 
-def extract_index(index_url, index_file):
+def downscale_image(img_data):
+    """
+    Shrink an image to illustration_max_size and re-encode it as JPEG
+    Returns (image bytes, file extension), unchanged if no size is set or Pillow is missing
+
+    @type img_data: bytes
+    @param img_data: original image
+    """
+
+    if illustration_max_size is None or not PILLOW_AVAILABLE:
+        return img_data, None
+
+    from PIL import Image
+    with Image.open(io.BytesIO(img_data)) as img:
+        img = img.convert('RGB')
+        img.thumbnail((illustration_max_size, illustration_max_size))
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=illustration_quality, optimize=True)
+
+    return buffer.getvalue(), '.jpg'
+
+
+def download_illustrations(image_url, image_dir):
+    """
+    Download all illustrations in parallel over the scraper session, downscaling them if configured
+    Returns the archive paths of the saved images relative to the chapter files, in page order
+
+    @type image_url: list
+    @param image_url: image URLs found in the '插图' chapter
+    @type image_dir: str
+    @param image_dir: folder the images are saved to
+    """
+
+    print("download_illustrations: Fetching %d illustrations ..." % len(image_url))
+
+    # Make the request appear like coming from a browser
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 '
+                      'Safari/537.36'}
+
+    os.makedirs(image_dir, exist_ok=True)
+
+    def save(index, url, img_data):
+        if img_data is None:
+            raise RuntimeError("download_illustrations: Failed to download %s" % url)
+
+        img_data, extension = downscale_image(img_data)
+        if extension is None:
+            extension = os.path.splitext(urlparse(url).path)[1].lower() or '.jpg'
+
+        image_name = 'illus_%03d%s' % (index + 1, extension)
+        with open(os.path.join(image_dir, image_name), 'wb') as handler:
+            handler.write(img_data)
+        return 'images/' + image_name
+
+    def download(index, url):
+        img_data, _ = fetch_cached(url, headers)
+        return save(index, url, img_data)
+
+    fetcher = async_fetcher()
+    if fetcher is not None:
+        image_hrefs = [None] * len(image_url)
+
+        def fetched(index, result, error):
+            if error is not None:
+                raise RuntimeError("download_illustrations: Failed to download %s: %s" % (image_url[index], error))
+            if chapter_store is not None:
+                chapter_store.put_image(image_url[index], *result)
+            image_hrefs[index] = save(index, image_url[index], result[0])
+
+        fetcher.fetch_all([(index, fetcher.fetch_bytes, url) for index, url in enumerate(image_url)], fetched)
+    else:
+        with ThreadPoolExecutor(max_workers=illustration_workers) as executor:
+            image_hrefs = list(executor.map(download, range(len(image_url)), image_url))
+
+    print("download_illustrations: Saved %d illustrations to %s" % (len(image_hrefs), image_dir))
+    return image_hrefs
+
+
+def write_illustration_page(image_page, chapter_name, image_hrefs):
+    """
+    Replace the downloaded '插图' chapter with an XHTML page showing the embedded images
+
+    @type image_page: str
+    @param image_page: html file name of the '插图' chapter
+    @type chapter_name: str
+    @param chapter_name: name of the chapter
+    @type image_hrefs: list
+    @param image_hrefs: image paths returned by download_illustrations
+    """
+
+    chapter_name = xml_text(chapter_name)
+    images = ''.join('\n<div><img src="%s" alt="%s %d"/></div>' % (xml_text(href), chapter_name, i + 1)
+                     for i, href in enumerate(image_hrefs))
+
+    write_chapter(image_page, '<html xmlns="http://www.w3.org/1999/xhtml">'
+                              "\n<head>"
+                              "\n<title>" + chapter_name + "</title>"
+                              "\n</head>"
+                              "\n<body>"
+                              "\n<h2>" + chapter_name + "</h2>" +
+                  images +
+                  "\n</body>"
+                  "\n</html>")
+
+
+def illustration_files(temp_dir):
+    """
+    (archive path, file name) of every illustration saved for a volume, empty if none were embedded
+
+    @type temp_dir: str
+    @param temp_dir: folder the chapters of the volume were downloaded to
+    """
+
+    image_dir = temp_dir + '/images'
+    if not os.path.isdir(image_dir):
+        return []
+    return [('images/' + name, image_dir + '/' + name) for name in sorted(os.listdir(image_dir))]
+
+
+def extract_index(index_url, index_file, volume_range=None):
     """
     Extract the book title, author, chapter names and urls from  'index.html' file
+    Returns a catalog.Catalog holding only the volumes chosen by the user
 
     @type index_url: str
     @param index_url: url to the index page
     @type index_file: str
     @param index_file: html file name containing the index page
+    @type volume_range: str
+    @param volume_range: volumes to keep, e.g. '2', '0-5' or 'all', None asks the user
     """
 
     print("extract_index: Extracting title, author and volume information from %s ..." % index_file)
@@ -304,10 +1380,47 @@ def extract_index(index_url, index_file):
     raw = open(index_file, 'r', encoding='utf-8-sig')
 
     # Create Beautiful soup object
-    soup = BeautifulSoup(raw, 'html.parser')
+    soup = parse_html(raw)
+
+    raw.close()
+
+    catalog = parse_index(soup, index_url)
+
+    # Multiple volumes found
+    if len(catalog.volumes) > 1:
+        if volume_range is None:
+            # Ask user to choose which volume(s) to download
+            start_volume, end_volume = choose_volume([volume.name for volume in catalog.volumes])
+        else:
+            start_volume, end_volume = parse_volume_range(volume_range, len(catalog.volumes))
+        catalog.volumes = catalog.volumes[start_volume:end_volume + 1]
+
+        # Take only the first part of the volume names e.g. '第一卷'
+        for volume in catalog.volumes:
+            volume.name = catalog.title + ' ' + volume.name.split()[0]
+
+    # Only 1 volume found
+    else:
+        # Volume name is simply book title, with nothing appended
+        for volume in catalog.volumes:
+            volume.name = catalog.title
+
+    return catalog
+
+
+def parse_index(soup, index_url):
+    """
+    Build the catalog of every volume and chapter in a single pass over the td elements
+    Volume names are the raw headings of the index page
+
+    @type soup: BeautifulSoup
+    @param soup: parsed index page
+    @type index_url: str
+    @param index_url: url to the index page, chapter links are relative to it
+    """
 
     # Book title is located in a div element
-    # with id = 'title' 
+    # with id = 'title'
     # Author is located in a div element
     # with id = 'info'
     title = soup.find(id='title').getText().strip()
@@ -315,70 +1428,58 @@ def extract_index(index_url, index_file):
     title = re.sub(r"[\(\[].*?[\)\]]", "", title)
     author = soup.find(id='info').getText().strip('作者：').strip()
 
-    # Find all table elements containing either chapter links or volume names
-    table_elem = soup.select('td')
-
-    # Remove empty td tags from result set
-    tag = '<td class="ccss">\u00a0</td>'
-    unwanted = BeautifulSoup(tag, "html.parser").td
-
-    nbsp_count = 0
+    catalog = Catalog(title, author)
+    base_link = index_url.replace('index.htm', '')
+    volume = None
 
-    for tag in table_elem:
-        if tag.text == '\u00a0':
-            nbsp_count += 1
+    # Table cells are either a volume heading (class 'vcss'), a chapter link or an empty '&nbsp;' filler
+    for td in soup.find_all('td'):
+        if 'vcss' in (td.get('class') or ()):
+            volume = Volume(td.getText().strip(), len(catalog.volumes))
+            catalog.volumes.append(volume)
+            continue
 
-    for _ in range(nbsp_count):
-        table_elem.remove(unwanted)
+        link = td.a
+        if link is None or volume is None:
+            continue
 
-    # Get the position of the volume headings
-    volume_indices = [i for i, td in enumerate(table_elem) if "vcss" in str(td)]
-    volume_indices.append((len(table_elem)))
+        href = link.get('href')
+        chapter_id = href.rsplit('/', 1)[-1].split('.')[0]
+        volume.chapters.append(Chapter(chapter_id, link.getText().strip(), base_link + href, len(volume.chapters)))
 
-    # Get volume names
-    volume_names = [vol.contents[0] for vol in soup.find_all("td", attrs={'class': "vcss"})]
+    return catalog
 
-    # Multiple volumes found
-    if len(volume_names) > 1:
-        # Ask user to choose which volume(s) to download
-        # Update volume indices and names lists to include only wanted volumes
-        volume_indices, volume_names = choose_volume(volume_indices, volume_names)
 
-        # Take only the first part of the volume names e.g. '第一卷'
-        volume_names = [' ' + name.split()[0] for name in volume_names]
-
-    # Only 1 volume found
-    else:
-        # Volume name is simply book title, with nothing appended
-        volume_names = ['']
-
-    # Store volume name, chapter name and chapter URL in nested dictionary
-    volume_chapters = {}
-    base_link = index_url.replace('index.htm', '')
+def parse_volume_range(volume_range, volume_count):
+    """
+    Turn a volume selection written as 'N', 'start-end' or 'all' into the first and last index
 
-    for i in range(len(volume_indices) - 1):
-        start_index = volume_indices[i] + 1
-        end_index = volume_indices[i + 1]
-        chapter_list = {}
+    @type volume_range: str
+    @param volume_range: volume selection, same syntax as the choose_volume prompt
+    @type volume_count: int
+    @param volume_count: number of volumes in the index
+    """
 
-        for k in range(start_index, end_index):
-            chapter = table_elem[k].a
-            chapter_list[chapter.getText().strip()] = base_link + chapter.get('href')
+    if str(volume_range).strip() == 'all':
+        return 0, volume_count - 1
 
-        volume_chapters[title + volume_names[i]] = chapter_list
+    chosen_indices = [int(index) for index in str(volume_range).split('-')]
+    if len(chosen_indices) == 1:
+        chosen_indices.append(chosen_indices[0])
 
-    raw.close()
+    if len(chosen_indices) != 2 or not 0 <= chosen_indices[0] <= chosen_indices[1] < volume_count:
+        raise ValueError("parse_volume_range: Invalid volume range '%s', index must be between 0 and %d"
+                         % (volume_range, volume_count - 1))
 
-    return title, author, volume_chapters
+    return chosen_indices[0], chosen_indices[1]
 
 
-def choose_volume(volume_indices, volume_names):
+def choose_volume(volume_names):
     """
     Multiple volumes found, ask user to select which volume(s) to download
+    Returns the first and last chosen index
 
-    @type volume_indices: list
-    @param volume_indices: indices of volume names in the table_elem list
-     @type volume_names: list
+    @type volume_names: list
     @param volume_names: volume names
     """
 
@@ -412,33 +1513,22 @@ def choose_volume(volume_indices, volume_names):
     else:
         end_volume = chosen_indices[0]
 
-    # Re-compute the required volume indices and names
-    volume_indices = [volume_indices[i] for i in range(start_volume, end_volume + 2)]
-    volume_names = [volume_names[i] for i in range(start_volume, end_volume + 1)]
+    return start_volume, end_volume
 
-    return volume_indices, volume_names
 
-
-def clean_chapter(chapter_file, chapter_name):
+def chapter_text(markup, parser=None, targeted=True):
     """
-    Clean up the html code in chapter retrieved by the request function
-
-    @type chapter_file: str
-    @param chapter_file: HTML file name of downloaded chapter
-    @type chapter_name: str
-    @param chapter_name: name of the chapter
+    Extract the plain chapter text from a downloaded chapter page
+
+    @type markup: str
+    @param markup: HTML source of the chapter page
+    @type parser: str
+    @param parser: 'lxml' or 'html.parser', None uses HTML_PARSER
+    @type targeted: bool
+    @param targeted: only build the div with id = 'content' instead of the whole page
     """
 
-    print("clean_chapter: Clean up html code in %s ..." % chapter_file)
-
-    # Open file in read mode 'r'
-    raw = open(chapter_file, 'r', encoding='utf-8-sig')
-
-    # Create Beautiful soup object
-    soup = BeautifulSoup(raw, 'html.parser')
-
-    # Close the file
-    raw.close()
+    soup = parse_html(markup, CONTENT_STRAINER if targeted else None, parser)
 
     # The chapter content is located in a div element with id = 'content'
     soup = soup.find(id='content')
@@ -451,262 +1541,466 @@ def clean_chapter(chapter_file, chapter_name):
         '最新最全的日本动漫轻小说 轻小说文库(http://www.wenku8.com) 为你一网打尽！', '')
 
     # Prevent wrong formatting, strip white spaces
-    text = text.lstrip().rstrip()
+    return text.lstrip().rstrip()
+
+
+def xml_text(text):
+    """
+    Escape text for XHTML content and attribute values, dropping characters XML does not allow
+
+    @type text: str
+    @param text: plain text
+    """
+
+    return escape(INVALID_XML_CHARS.sub('', text), {'"': '&quot;'})
+
+
+def chapter_paragraphs(text):
+    """
+    Turn chapter text into escaped '<p>' elements, one per non-empty line
+    Two or more blank lines in a row (a scene break) become an empty paragraph
+
+    @type text: str
+    @param text: text returned by chapter_text
+    """
+
+    paragraphs = []
+    blank_lines = 0
+    for line in text.split('\n'):
+        # Lines of only spaces or '&nbsp;' are blank, leading spaces of a paragraph are its indent
+        if not line.strip():
+            blank_lines += 1
+            continue
+        if blank_lines >= 2 and paragraphs:
+            paragraphs.append('<p><br/></p>')
+        blank_lines = 0
+        paragraphs.append('<p>' + xml_text(line.rstrip()) + '</p>')
+
+    return paragraphs
+
+
+def split_chapter(xhtml, max_bytes=CHAPTER_SPLIT_BYTES):
+    """
+    Split a chapter written by clean_chapter into documents of about max_bytes, cutting between
+    paragraphs, every part keeps the head of the chapter and only the first one its heading
+    Chapters without one element per body line (e.g. cleaned by an older version) are returned whole
+
+    @type xhtml: str
+    @param xhtml: chapter XHTML
+    @type max_bytes: int
+    @param max_bytes: size in bytes a part may have, a single bigger paragraph gets a part of its own
+    """
+
+    head, body_start, rest = xhtml.partition('\n<body>')
+    body, body_end, tail = rest.rpartition('\n</body>')
+    lines = body.split('\n')[1:]
+    if not body_start or not body_end or not all(line.startswith('<') and line.endswith('>') for line in lines):
+        return [xhtml]
+
+    shell = len((head + body_start + body_end + tail).encode('utf-8'))
+    parts = [[]]
+    size = shell
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if parts[-1] and size + line_size > max_bytes:
+            parts.append([])
+            size = shell
+        parts[-1].append(line)
+        size += line_size
+
+    return [head + body_start + ''.join('\n' + line for line in part) + body_end + tail for part in parts]
 
-    # Replace next line characters with br tags
-    text = text.replace('\n\n\n', '\n<br/>\n<br/>\n')
 
-    # Replace special character '&' with '&amp;'
-    text = text.replace('&', '&amp;')
+def chapter_parts(chapter, max_bytes=CHAPTER_SPLIT_BYTES):
+    """
+    Contents of the spine items of one chapter, the chapter itself unless it is bigger than max_bytes
 
-    # Write text to HTML file
-    file = open(chapter_file, 'w', encoding='utf-8-sig')
+    @type chapter: str or bytes
+    @param chapter: file name or bytes of the chapter XHTML, as in the chapter_list of create_epub
+    @type max_bytes: int
+    @param max_bytes: size in bytes above which the chapter is split
+    """
 
-    # In the first line, write the HTML with the xmlns Attribute.
-    # By convention, epub files are using the XHTML file format
-    file.write('<html xmlns="http://www.w3.org/1999/xhtml">')
+    size = len(chapter) if isinstance(chapter, bytes) else os.path.getsize(chapter)
+    if size <= max_bytes:
+        return [chapter]
 
-    # Place chapter name inside title tags
-    # Surrounded by the head tag
-    file.write("\n<head>")
-    file.write("\n<title>" + chapter_name + "</title>")
-    file.write("\n</head>")
+    if isinstance(chapter, bytes):
+        xhtml = chapter.decode('utf-8-sig')
+    else:
+        with open(chapter, 'r', encoding='utf-8-sig') as f:
+            xhtml = f.read()
 
-    # Write the body
-    # Use h2 tag on the title
-    # Placing <p> at the beginning
-    file.write("\n<body>")
-    file.write("\n<h2>" + chapter_name + "</h2>" + "\n<p>")
-    file.write(text)
+    return [part.encode('utf-8-sig') for part in split_chapter(xhtml, max_bytes)]
 
-    # Close all tags
-    file.write("\n</p>")
-    file.write("\n</body>")
-    file.write("\n</html>")
 
-    # Close file
-    file.close()
+def clean_chapter(chapter_file, chapter_name):
+    """
+    Clean up the html code in chapter retrieved by the request function, returns the XHTML written
+
+    @type chapter_file: str
+    @param chapter_file: HTML file name of downloaded chapter
+    @type chapter_name: str
+    @param chapter_name: name of the chapter
+    """
+
+    print("clean_chapter: Clean up html code in %s ..." % chapter_file)
 
+    with metrics.timer('clean_chapter', chapter_file) as sample:
+        # Read the downloaded page, from memory or from the file
+        markup = read_chapter(chapter_file)
 
-def create_epub(title, author, chapter_list):
+        # Extract the chapter text
+        parse_start = time.perf_counter()
+        text = chapter_text(markup)
+        sample.update(parse_time=time.perf_counter() - parse_start, bytes=len(markup))
+
+        # One escaped paragraph per line
+        paragraphs = chapter_paragraphs(text)
+        chapter_name = xml_text(chapter_name)
+
+        # In the first line, write the HTML with the xmlns Attribute.
+        # By convention, epub files are using the XHTML file format
+        xhtml = '<html xmlns="http://www.w3.org/1999/xhtml">'
+
+        # Place chapter name inside title tags
+        # Surrounded by the head tag
+        xhtml += "\n<head>"
+        xhtml += "\n<title>" + chapter_name + "</title>"
+        xhtml += "\n</head>"
+
+        # Write the body
+        # Use h2 tag on the title, every paragraph on its own line so split_chapter can cut between them
+        xhtml += "\n<body>"
+        xhtml += "\n<h2>" + chapter_name + "</h2>"
+        xhtml += ''.join("\n" + paragraph for paragraph in paragraphs)
+
+        # Close all tags
+        xhtml += "\n</body>"
+        xhtml += "\n</html>"
+
+        # Write text to HTML file
+        write_chapter(chapter_file, xhtml)
+
+    return xhtml
+
+
+def create_epub(title, author, chapter_list, cover_file="../temp/cover.jpg", images=None):
     """
     Create epub file from the retrieved book info and downloaded, cleaned chapters
+    Every part is generated in memory and streamed straight into the epub file
+    Chapters bigger than CHAPTER_SPLIT_BYTES are split into several files, see chapter_parts
+    Returns False without touching the epub if its parts are the same as when it was last built
 
     @type title: str
     @param title: volume/book title
     @type author: str
     @param author: author name
-    @type chapter_list: dict
-    @param chapter_list: chapter names and file locations
+    @type chapter_list: list
+    @param chapter_list: (chapter name, file location or XHTML bytes) pairs in reading order
+    @type cover_file: str
+    @param cover_file: file location of the cover image
+    @type images: list
+    @param images: (archive path relative to OEBPS, file location) of embedded illustrations
     """
 
     print("create_epub: starting ...")
 
-    # mimetype file (same for every epub)
-    file = open("../book/mimetype", 'w')
-    file.write("application/epub+zip")
-
-    # Close mimetype file
-    file.close()
-
-    # container.xml file (same for every epub)
-    # Inside folder 'META-INF'
-    # referenced Content.opf, located inside OEBPS folder
-    file = open("../book/META-INF/container.xml", 'w')
-
-    file.write(dedent('''\
-    <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
-        <rootfiles>
-            <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
-        </rootfiles>
-    </container>'''))
-
-    # Close container.xml file
-    file.close()
-
-    # content.opf file
-    file = open("../book/OEBPS/content.opf", 'w', encoding='utf-8-sig')
-
-    # Inside metadata, manifest and spine tag, we insert strings
-    index_tpl = dedent("""\
-    <?xml version='1.0' encoding='utf-8'?>
-    <package unique-identifier="id" version="3.0" xmlns="http://www.idpf.org/2007/opf" prefix="rendition: http://www.idpf.org/vocab/rendition/#">
-        <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
-            %(metadata)s
-        </metadata>
+    with metrics.timer('create_epub', title) as sample:
+        # Names as they appear inside the XML files
+        novelname = xml_text(title)
+        author_name = xml_text(author)
+
+        # Parts of the epub in archive order, (archive name, bytes or name of a file to copy)
+        parts = []
+
+        # mimetype file (same for every epub)
+        parts.append(("mimetype", b"application/epub+zip"))
+
+        # container.xml file (same for every epub)
+        # Inside folder 'META-INF'
+        # referenced Content.opf, located inside OEBPS folder
+        parts.append(("META-INF/container.xml", dedent('''\
+        <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+            <rootfiles>
+                <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+            </rootfiles>
+        </container>''').encode('utf-8')))
+
+        # content.opf file
+        # Inside metadata, manifest and spine tag, we insert strings
+        index_tpl = dedent("""\
+        <?xml version='1.0' encoding='utf-8'?>
+        <package unique-identifier="id" version="3.0" xmlns="http://www.idpf.org/2007/opf" prefix="rendition: http://www.idpf.org/vocab/rendition/#">
+            <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+                %(metadata)s
+            </metadata>
         
-        <manifest>
-            %(manifest)s
-        </manifest>
+            <manifest>
+                %(manifest)s
+            </manifest>
         
-        <spine toc="ncx">
-            %(spine)s
-        </spine>
-    </package>""")
-
-    # Create metadata string
-    metadata = dedent("""\
-    <meta property="dcterms:modified">%(time)s</meta>
-    \t\t<meta content="Ebook-lib 0.17.1" name="generator"/>
-    \t\t<dc:language>en</dc:language>
-    \t\t<dc:identifier id="id">%(novelname)s, %(author)s</dc:identifier>
-    \t\t<dc:title>%(novelname)s</dc:title>
-    \t\t<dc:creator id="creator">%(author)s</dc:creator>
-    \t\t<meta name="cover" content="cover-img"></meta>"""
-                      % {"time": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), "novelname": title, "author": author})
-
-    # Create a string that contains the manifest data for the table of content,
-    # that will be added at the end of the manifest string.
-    toc_manifest = '\t\t<item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>\n'
-    nav_manifest = '\t\t<item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>'
-
-    # Manifest and spine strings
-    manifest = '<item href="cover.jpg" id="cover-img" media-type="image/jpeg" properties="cover-image"/>\n'
-    manifest += '\t\t<item href="cover.xhtml" id="cover" media-type="application/xhtml+xml"/>\n'
-    spine = '<itemref idref="cover" linear="no"/>\n\t\t<itemref idref="nav"/>\n'
-
-    # Add chapter references to both manifest and spine strings
-    for i, chapter in enumerate(chapter_list.values()):
-        manifest += '\t\t<item id="chapter_%s" href="chapter_%s.xhtml" media-type="application/xhtml+xml"/>\n' % (
-            i + 1, i + 1)
-        spine += '\t\t<itemref idref="chapter_%s"/>\n' % (i + 1)
-
-        shutil.copyfile(chapter, "../book/OEBPS/chapter_%s.xhtml" % (i + 1))
-
-    # Copy the cover image
-    shutil.copyfile("../temp/cover.jpg", "../book/OEBPS/cover.jpg")
-
-    # Write content.opf file
-    file.write(index_tpl % {
-        "metadata": metadata,
-        "manifest": manifest + toc_manifest + nav_manifest,
-        "spine": spine})
-
-    # Close content.opf file
-    file.close()
-
-    # Table of content file 'toc.ncx'
-    file = open("../book/OEBPS/toc.ncx", 'w', encoding='utf-8-sig')
-
-    toc = dedent("""\
-    <?xml version='1.0' encoding='utf-8'?>
-    <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
-        <head>
-            <meta content="%(novelname)s, %(author)s" name="dtb:uid"/>
-            <meta content="0" name="dtb:depth"/>
-            <meta content="0" name="dtb:totalPageCount"/>
-            <meta content="0" name="dtb:maxPageNumber"/>
-        </head>
+            <spine toc="ncx">
+                %(spine)s
+            </spine>
+        </package>""")
+
+        # Create metadata string
+        metadata = dedent("""\
+        <meta property="dcterms:modified">%(time)s</meta>
+        \t\t<meta content="Ebook-lib 0.17.1" name="generator"/>
+        \t\t<dc:language>en</dc:language>
+        \t\t<dc:identifier id="id">%(novelname)s, %(author)s</dc:identifier>
+        \t\t<dc:title>%(novelname)s</dc:title>
+        \t\t<dc:creator id="creator">%(author)s</dc:creator>
+        \t\t<meta name="cover" content="cover-img"></meta>"""
+                          % {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(EPUB_EPOCH)),
+                             "novelname": novelname,
+                             "author": author_name})
+
+        # Create a string that contains the manifest data for the table of content,
+        # that will be added at the end of the manifest string.
+        toc_manifest = '\t\t<item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>\n'
+        nav_manifest = '\t\t<item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>'
+
+        # Manifest and spine strings
+        manifest = '<item href="cover.jpg" id="cover-img" media-type="image/jpeg" properties="cover-image"/>\n'
+        manifest += '\t\t<item href="cover.xhtml" id="cover" media-type="application/xhtml+xml"/>\n'
+        spine = '<itemref idref="cover" linear="no"/>\n\t\t<itemref idref="nav"/>\n'
+
+        # Chapter and cover files are copied into the epub after the generated files
+        files = []
+
+        # Add chapter references to both manifest and spine strings
+        # Big chapters become several spine items 'chapter_<n>.xhtml', 'chapter_<n>_2.xhtml', ...,
+        # the table of content only links the first one
+        for i, (_, chapter) in enumerate(chapter_list):
+            for j, content in enumerate(chapter_parts(chapter)):
+                name = "chapter_%s" % (i + 1) if j == 0 else "chapter_%s_%s" % (i + 1, j + 1)
+                manifest += '\t\t<item id="%s" href="%s.xhtml" media-type="application/xhtml+xml"/>\n' % (
+                    name, name)
+                spine += '\t\t<itemref idref="%s"/>\n' % name
+
+                files.append(("OEBPS/%s.xhtml" % name, content))
+
+        # Copy the cover image
+        files.append(("OEBPS/cover.jpg", cover_file))
+
+        # Add embedded illustrations to the manifest
+        for i, (image_href, image_file) in enumerate(images or []):
+            media_type = IMAGE_MEDIA_TYPES.get(os.path.splitext(image_href)[1].lower(), 'image/jpeg')
+            manifest += '\t\t<item id="illus_%s" href="%s" media-type="%s"/>\n' % (i + 1, image_href, media_type)
+            files.append(("OEBPS/" + image_href, image_file))
+
+        # Write content.opf file
+        parts.append(("OEBPS/content.opf", (index_tpl % {
+            "metadata": metadata,
+            "manifest": manifest + toc_manifest + nav_manifest,
+            "spine": spine}).encode('utf-8-sig')))
+
+        # Table of content file 'toc.ncx'
+
+        toc = dedent("""\
+        <?xml version='1.0' encoding='utf-8'?>
+        <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+            <head>
+                <meta content="%(novelname)s, %(author)s" name="dtb:uid"/>
+                <meta content="0" name="dtb:depth"/>
+                <meta content="0" name="dtb:totalPageCount"/>
+                <meta content="0" name="dtb:maxPageNumber"/>
+            </head>
         
-        <docTitle>
-            <text>%(novelname)s</text>
-        </docTitle>
+            <docTitle>
+                <text>%(novelname)s</text>
+            </docTitle>
         
-        <navMap>
-    %(navpoints)s
-        </navMap>
-    </ncx>""")
-
-    navpoints = ''
-
-    # Add chapter name to table of content
-    for i, chapter_name in enumerate(chapter_list.keys()):
-        navpoints += '\t\t<navPoint id="chapter_%s">\n' % (i + 1)
-        navpoints += '\t\t\t<navLabel>\n'
-        navpoints += '\t\t\t\t<text>%s</text>\n' % chapter_name
-        navpoints += '\t\t\t</navLabel>\n'
-        navpoints += '\t\t\t<content src="chapter_%s.xhtml"/>\n' % (i + 1)
-        navpoints += '\t\t</navPoint>\n'
-
-    # Write the toc.xhtml file to epub
-    file.write(toc % {"novelname": title,
-                      "author": author,
-                      "navpoints": navpoints})
-    # Close toc.ncx
-    file.close()
-
-    # Create nav.xhtml file
-    file = open("../book/OEBPS/nav.xhtml", 'w', encoding='utf-8-sig')
-
-    nav = dedent("""\
-    <?xml version='1.0' encoding='utf-8'?>
-    <!DOCTYPE html>
-    <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
-        <head>
-            <title>%(novelname)s</title>
-        </head>
-        <body>
-            <nav id="id" role="doc-toc" epub:type="toc">
-                <h2>%(novelname)s</h2>
+            <navMap>
+        %(navpoints)s
+            </navMap>
+        </ncx>""")
+
+        navpoints = ''
+
+        # Add chapter name to table of content
+        for i, (chapter_name, _) in enumerate(chapter_list):
+            navpoints += '\t\t<navPoint id="chapter_%s">\n' % (i + 1)
+            navpoints += '\t\t\t<navLabel>\n'
+            navpoints += '\t\t\t\t<text>%s</text>\n' % xml_text(chapter_name)
+            navpoints += '\t\t\t</navLabel>\n'
+            navpoints += '\t\t\t<content src="chapter_%s.xhtml"/>\n' % (i + 1)
+            navpoints += '\t\t</navPoint>\n'
+
+        # Write the toc.xhtml file to epub
+        parts.append(("OEBPS/toc.ncx", (toc % {"novelname": novelname,
+                                               "author": author_name,
+                                               "navpoints": navpoints}).encode('utf-8-sig')))
+
+        # Create nav.xhtml file
+
+        nav = dedent("""\
+        <?xml version='1.0' encoding='utf-8'?>
+        <!DOCTYPE html>
+        <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
+            <head>
+                <title>%(novelname)s</title>
+            </head>
+            <body>
+                <nav id="id" role="doc-toc" epub:type="toc">
+                    <h2>%(novelname)s</h2>
             
-                <ol>
-                    <li>
-                        <a href="cover.xhtml">封面</a>
-                    </li>
-    %(ol_content)s
-                </ol>
-            </nav>
-        </body>
-    </html>""")
-    ol_content = ""
+                    <ol>
+                        <li>
+                            <a href="cover.xhtml">封面</a>
+                        </li>
+        %(ol_content)s
+                    </ol>
+                </nav>
+            </body>
+        </html>""")
+        ol_content = ""
+
+        # Add chapter names
+        for i, (chapter_name, _) in enumerate(chapter_list):
+            ol_content += '\t\t\t\t<li>\n'
+            ol_content += '\t\t\t\t\t<a href="chapter_%s.xhtml">%s</a>\n' % (i + 1, xml_text(chapter_name))
+            ol_content += '\t\t\t\t</li>\n'
+
+        parts.append(("OEBPS/nav.xhtml", (nav % {"novelname": novelname,
+                                                 "ol_content": ol_content}).encode('utf-8-sig')))
+
+        # Create cover.xhtml
+
+        cover_xhtml = dedent("""\
+        <?xml version='1.0' encoding='utf-8'?>
+        <!DOCTYPE html>
+        <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" epub:prefix="z3998: http://www.daisy.org/z3998/2012/vocab/structure/#" lang="en" xml:lang="en">
+            <head>
+                <title>Cover</title>
+            </head>
+            <body>
+                <img src="cover.jpg" alt="Cover"/>
+            </body>
+        </html>""")
+
+        parts.append(("OEBPS/cover.xhtml", cover_xhtml.encode('utf-8')))
+
+        # Nothing to write if the same parts were packed into this epub before
+        inputs_hash = epub_inputs_hash(parts + files)
+        if build_is_cached(title, inputs_hash):
+            print("create_epub: '%s' unchanged since it was last built, skipping" % title)
+            sample['cached'] = True
+            return False
+
+        # Stream all parts into the epub file
+        pack_start = time.perf_counter()
+        compress_epub(title, parts + files)
+        sample['pack_time'] = time.perf_counter() - pack_start
+        record_build(title, inputs_hash)
+
+        print("create_epub: Finish EPUB conversion and download for book '%s'!" % title)
+        return True
+
 
-    # Add chapter names
-    for i, chapter_name in enumerate(chapter_list.keys()):
-        ol_content += '\t\t\t\t<li>\n'
-        ol_content += '\t\t\t\t\t<a href="chapter_%s.xhtml">%s</a>\n' % (i + 1, chapter_name)
-        ol_content += '\t\t\t\t</li>\n'
+def compress_epub(title, parts):
+    """
+    Write the parts of the book straight into the epub file, no staging folder on disk
+    'mimetype' must be the first part, it is stored uncompressed as the EPUB spec requires
 
-    file.write(nav % {"novelname": title,
-                      "ol_content": ol_content})
+    @type title: str
+    @param title: volume/book title
+    @type parts: list
+    @param parts: (archive name, bytes or name of a file to copy) tuples, in archive order
+    """
 
-    # Close nav.xhtml file
-    file.close()
+    epub_folder = "../epub/"
+    # Check if folder exists, if not create it
+    os.makedirs(epub_folder, exist_ok=True)
 
-    # Create cover.xhtml
-    file = open("../book/OEBPS/cover.xhtml", 'w')
+    # Written next to the old epub and swapped in at the end, readers never see half a file
+    epub_file = '../epub/' + title + ".epub"
+    tmp_file = epub_file + '.tmp'
 
-    cover_xhtml = dedent("""\
-    <?xml version='1.0' encoding='utf-8'?>
-    <!DOCTYPE html>
-    <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" epub:prefix="z3998: http://www.daisy.org/z3998/2012/vocab/structure/#" lang="en" xml:lang="en">
-        <head>
-            <title>Cover</title>
-        </head>
-        <body>
-            <img src="cover.jpg" alt="Cover"/>
-        </body>
-    </html>""")
+    # Create a zipfile with variable name epub
+    with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as epub:
+        for arcname, content in parts:
+            # Same date, permissions and system for every entry instead of the file's own,
+            # so the epub only changes when its content does
+            info = zipfile.ZipInfo(arcname, date_time=time.gmtime(EPUB_EPOCH)[:6])
+            info.compress_type = zipfile.ZIP_STORED if arcname == "mimetype" else zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            if isinstance(content, bytes):
+                epub.writestr(info, content)
+            else:
+                with open(content, 'rb') as src, epub.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    os.replace(tmp_file, epub_file)
+
+
+def epub_inputs_hash(parts):
+    """
+    SHA-256 over the archive names and contents of the parts of an epub, in archive order
+    Chapters, cover, images and metadata all end up in the parts, so any change to them changes the hash
 
-    file.write(cover_xhtml)
+    @type parts: list
+    @param parts: (archive name, bytes or name of a file) tuples as passed to compress_epub
+    """
 
-    # Close cover.xhtml
-    file.close()
+    digest = hashlib.sha256()
+    for arcname, content in parts:
+        digest.update(arcname.encode('utf-8') + b'\0')
+        if isinstance(content, bytes):
+            digest.update(b'%d\0' % len(content))
+            digest.update(content)
+        else:
+            digest.update(b'%d\0' % os.path.getsize(content))
+            with open(content, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+    return digest.hexdigest()
 
-    # Compress '/book' folder and its content to epub file
-    compress_epub(title)
 
-    print("create_epub: Finish EPUB conversion and download for book '%s'!" % title)
+def build_record_path(title):
+    # One small file per epub, pack processes never write the same file
+    return os.path.join(build_cache_dir, hashlib.sha1(title.encode('utf-8')).hexdigest() + '.json')
 
 
-def compress_epub(title):
+def build_is_cached(title, inputs_hash):
     """
-    Compress '/book' folder and its content to epub file
+    Check if '../epub/<title>.epub' was built from parts with this hash and is still there unchanged
 
     @type title: str
     @param title: volume/book title
+    @type inputs_hash: str
+    @param inputs_hash: hash returned by epub_inputs_hash
     """
 
-    epub_folder = "../epub/"
-    # Check if folder exists, if not create it
-    os.makedirs(epub_folder, exist_ok=True)
-    
-    # Create a zipfile with variable name epub
-    epub = zipfile.ZipFile('../epub/' + title + ".epub", "w")
-    path = "../book"
-    length = len(path)
-
-    for root, dirs, files in os.walk(path):
-        folder = root[length:]  # path without "parent"
-        for file in files:
-            epub.write(os.path.join(root, file), os.path.join(folder, file))
-    epub.close()
+    if build_cache_dir is None:
+        return False
+    try:
+        with open(build_record_path(title), 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        return record['inputs'] == inputs_hash and os.path.getsize('../epub/' + title + '.epub') == record['size']
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def record_build(title, inputs_hash):
+    """
+    Remember the hash of the parts '../epub/<title>.epub' was just built from
+
+    @type title: str
+    @param title: volume/book title
+    @type inputs_hash: str
+    @param inputs_hash: hash returned by epub_inputs_hash
+    """
+
+    if build_cache_dir is None:
+        return
+    os.makedirs(build_cache_dir, exist_ok=True)
+    record_file = build_record_path(title)
+    with open(record_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'epub': title, 'inputs': inputs_hash,
+                   'size': os.path.getsize('../epub/' + title + '.epub')}, f, ensure_ascii=False)
+    os.replace(record_file + '.tmp', record_file)
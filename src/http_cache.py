@@ -0,0 +1,202 @@
+# On-disk cache of downloaded pages and images, shared between runs of main.py
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class HttpCache:
+    """
+    URL keyed cache, every entry is a '<sha256>.body' file plus a '<sha256>.json' metadata file
+
+    @type directory: str
+    @param directory: folder holding the cache, it is not touched by create_temp_dir
+    @type ttl: float
+    @param ttl: seconds an entry is used without asking the server again
+    @type max_bytes: int
+    @param max_bytes: total size of cached bodies kept after evict()
+    """
+
+    def __init__(self, directory="../cache", ttl=7 * 24 * 3600, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        """
+        Body and metadata file names for a url
+
+        @type url: str
+        @param url: cached url
+        """
+
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + '.body', base + '.json'
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """
+        Write bytes to a temporary file and move it into place, so readers never see half a file
+        """
+
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, url):
+        """
+        Return (content, metadata) of a cached url, or None if it is not cached
+
+        @type url: str
+        @param url: cached url
+        """
+
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # Body mtime doubles as the last access time for LRU eviction
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+
+        return content, meta
+
+    def is_fresh(self, meta, max_age=None):
+        """
+        Check if a cached entry can be used without revalidation
+
+        @type meta: dict
+        @param meta: metadata returned by get()
+        @type max_age: float
+        @param max_age: overrides ttl for this lookup, 0 always revalidates
+        """
+
+        max_age = self.ttl if max_age is None else max_age
+        return time.time() - meta['stored_at'] < max_age
+
+    @staticmethod
+    def validators(meta):
+        """
+        Conditional request headers for a cached entry, empty if the server sent no validators
+
+        @type meta: dict
+        @param meta: metadata returned by get()
+        """
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, content, headers=None):
+        """
+        Save a response body and its validators
+
+        @type url: str
+        @param url: fetched url
+        @type content: bytes
+        @param content: response body
+        @type headers: dict
+        @param headers: response headers, None for pages rendered by the browser
+        """
+
+        headers = headers or {}
+        meta = {
+            'url': url,
+            'stored_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_type': headers.get('Content-Type'),
+            'size': len(content),
+        }
+
+        body_path, meta_path = self._paths(url)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+        self._write_atomic(body_path, content)
+        self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+        return meta
+
+    def refresh(self, url, meta):
+        """
+        Mark an entry as fresh again after the server answered 304 Not Modified
+
+        @type url: str
+        @param url: cached url
+        @type meta: dict
+        @param meta: metadata returned by get()
+        """
+
+        meta['stored_at'] = time.time()
+        self._write_atomic(self._paths(url)[1], json.dumps(meta).encode('utf-8'))
+
+    def evict(self):
+        """
+        Delete entries older than ttl without validators, then least recently used entries
+        until the cache fits in max_bytes
+        """
+
+        if not os.path.isdir(self.directory):
+            return
+
+        entries = []
+        now = time.time()
+        removed = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.directory, name)
+            body_path = meta_path[:-len('.json')] + '.body'
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                accessed = os.path.getmtime(body_path)
+            except (OSError, ValueError):
+                self._remove(meta_path, body_path)
+                removed += 1
+                continue
+
+            # Expired entries that cannot be revalidated are useless
+            expired = now - meta['stored_at'] >= self.ttl
+            if expired and not (meta.get('etag') or meta.get('last_modified')):
+                self._remove(meta_path, body_path)
+                removed += 1
+                continue
+
+            entries.append((accessed, meta.get('size', 0), meta_path, body_path))
+
+        total = sum(size for _, size, _, _ in entries)
+        for accessed, size, meta_path, body_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(meta_path, body_path)
+            total -= size
+            removed += 1
+
+        print("HttpCache: Evicted %d entries, %.1f MB cached" % (removed, total / 1024 / 1024))
+
+    @staticmethod
+    def _remove(*paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,313 @@
+# Shared task queue for worker processes: fetch, clean and pack tasks with leases, so a task whose
+# worker died is picked up again, plus a token bucket every process draws from for one site-wide rate limit
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from chapter_store import BUSY_TIMEOUT
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    task_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    group_name TEXT,
+    after_group TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL,
+    error TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, not_before);
+CREATE INDEX IF NOT EXISTS tasks_by_group ON tasks (group_name, state);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    host TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def connect(path):
+    """
+    Open the queue database, shared by every process on the machine (or on a shared disk)
+
+    @type path: str
+    @param path: database file, created with its folder if needed
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # isolation_level None: transactions are started explicitly with BEGIN IMMEDIATE
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+class JobQueue:
+    """
+    Tasks in a SQLite database. A claimed task is leased to its worker for lease seconds,
+    a lease that runs out (worker killed or stuck) makes the task claimable again
+    Tasks of a group (e.g. the chapters of a volume) can hold back a task such as packing
+    the volume through after_group until every one of them is done
+
+    @type path: str
+    @param path: database file
+    @type max_attempts: int
+    @param max_attempts: claims a task gets before it is marked failed
+    """
+
+    def __init__(self, path="../store/jobs.sqlite3", max_attempts=5):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._db = connect(path)
+        self._lock = threading.Lock()
+
+    def _transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same task
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    @staticmethod
+    def _reopen_waiting(db, groups):
+        # New work in a group makes what was built from it out of date, e.g. the epub of a volume
+        # that got new chapters. A leased task is taken back, its worker's complete() then fails
+        now = time.time()
+        for group in groups:
+            db.execute("UPDATE tasks SET state = 'pending', attempts = 0, not_before = 0, lease_owner = NULL, "
+                       "error = NULL, updated_at = ? WHERE after_group = ? AND state != 'pending'", (now, group))
+
+    @staticmethod
+    def _insert(db, tasks):
+        now = time.time()
+        grown = set()
+        for kind, key, payload, group, after_group in tasks:
+            data = json.dumps(payload, ensure_ascii=False)
+            # A failed task is queued again with fresh attempts, any other state is left as it is
+            added = db.execute("INSERT INTO tasks (kind, task_key, payload, group_name, after_group, updated_at) "
+                               "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (task_key) DO UPDATE SET state = 'pending', "
+                               "payload = excluded.payload, attempts = 0, not_before = 0, error = NULL, "
+                               "updated_at = excluded.updated_at WHERE state = 'failed'",
+                               (kind, key, data, group, after_group, now)).rowcount
+            if added and group is not None:
+                grown.add(group)
+            elif not added:
+                # Keep the latest payload, e.g. the chapter list of a volume to pack
+                db.execute("UPDATE tasks SET payload = ? WHERE task_key = ? AND payload != ?", (data, key, data))
+        JobQueue._reopen_waiting(db, grown)
+
+    def put(self, tasks):
+        """
+        Add tasks, a task whose key is already queued is left as it is unless it or a task of its group failed
+        Tasks waiting for a group that gets new or retried tasks are queued again, even if they were done
+
+        @type tasks: list
+        @param tasks: (kind, key, payload, group, after group) tuples, payload must be JSON serialisable,
+                      group and after group may be None
+        """
+
+        def add(db):
+            self._insert(db, tasks)
+            # Failed follow-ups of these tasks (e.g. a clean task) get another chance as well
+            retried = set()
+            for group in {task[3] for task in tasks if task[3] is not None}:
+                if db.execute("UPDATE tasks SET state = 'pending', attempts = 0, not_before = 0, error = NULL "
+                              "WHERE group_name = ? AND state = 'failed'", (group,)).rowcount:
+                    retried.add(group)
+            self._reopen_waiting(db, retried)
+
+        self._transaction(add)
+
+    def claim(self, worker, lease=120):
+        """
+        Lease the next runnable task to worker, returns (task id, kind, payload, attempt) or None
+        Runnable means pending (or leased with an expired lease), not waiting for a retry delay
+        and, if it has an after group, every task of that group is done
+
+        @type worker: str
+        @param worker: unique name of the worker thread
+        @type lease: float
+        @param lease: seconds the task belongs to worker unless heartbeat() extends it
+        """
+
+        def claim_next(db):
+            now = time.time()
+            # Tasks waiting for a group that can no longer finish would wait forever
+            db.execute("UPDATE tasks SET state = 'failed', error = 'a task it waits for failed', updated_at = ? "
+                       "WHERE state = 'pending' AND after_group IN "
+                       "(SELECT group_name FROM tasks WHERE state = 'failed')", (now,))
+            row = db.execute("""
+                SELECT id, kind, payload, attempts FROM tasks AS t
+                WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) AND not_before <= ?
+                AND (after_group IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM tasks AS g WHERE g.group_name = t.after_group AND g.state != 'done'))
+                ORDER BY id LIMIT 1""", (now, now)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE tasks SET state = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                       "lease_until = ?, updated_at = ? WHERE id = ?", (worker, now + lease, now, row[0]))
+            return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+        return self._transaction(claim_next)
+
+    def heartbeat(self, task_id, worker, lease=120):
+        """
+        Extend the lease of a running task, returns False if the lease was lost to another worker
+
+        @type task_id: int
+        @param task_id: task returned by claim()
+        @type worker: str
+        @param worker: worker holding the lease
+        @type lease: float
+        @param lease: seconds from now the lease lasts
+        """
+
+        def extend(db):
+            return db.execute("UPDATE tasks SET lease_until = ? WHERE id = ? AND state = 'leased' "
+                              "AND lease_owner = ?", (time.time() + lease, task_id, worker)).rowcount == 1
+
+        return self._transaction(extend)
+
+    def complete(self, task_id, worker, follow_ups=()):
+        """
+        Mark a task done and queue the tasks that follow it in the same transaction, so its group
+        is never seen as finished in between
+        Returns False, changing nothing, if the lease was lost and another worker owns the task now
+
+        @type task_id: int
+        @param task_id: task returned by claim()
+        @type worker: str
+        @param worker: worker holding the lease
+        @type follow_ups: list
+        @param follow_ups: tasks to add, as for put()
+        """
+
+        def finish(db):
+            done = db.execute("UPDATE tasks SET state = 'done', lease_owner = NULL, updated_at = ? "
+                              "WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+                              (time.time(), task_id, worker)).rowcount == 1
+            if done:
+                self._insert(db, follow_ups)
+            return done
+
+        return self._transaction(finish)
+
+    def fail(self, task_id, worker, error, retry_delay=0):
+        """
+        Give a task back after an error, it is retried after retry_delay seconds
+        or marked failed once it was claimed max_attempts times
+
+        @type task_id: int
+        @param task_id: task returned by claim()
+        @type worker: str
+        @param worker: worker holding the lease
+        @type error: str
+        @param error: message kept with the task
+        @type retry_delay: float
+        @param retry_delay: seconds before the task may be claimed again
+        """
+
+        def give_back(db):
+            now = time.time()
+            db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                       "lease_owner = NULL, not_before = ?, error = ?, updated_at = ? "
+                       "WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+                       (self.max_attempts, now + retry_delay, error, now, task_id, worker))
+
+        self._transaction(give_back)
+
+    def counts(self):
+        """
+        Number of tasks per state, e.g. {'pending': 3, 'leased': 2, 'done': 40}
+        """
+
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+
+    def failures(self):
+        """
+        (kind, key, error) of every failed task
+        """
+
+        with self._lock:
+            return self._db.execute("SELECT kind, task_key, error FROM tasks WHERE state = 'failed' "
+                                    "ORDER BY id").fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SharedTokenBucket:
+    """
+    Token bucket kept in the queue database, so every worker process shares one rate limit per host
+    Same interface as fetch_control.TokenBucket
+
+    @type path: str
+    @param path: queue database file
+    @type host: str
+    @param host: host name the bucket limits
+    @type rate: float
+    @param rate: tokens added per second over all processes, None or 0 for no limit
+    @type burst: int
+    @param burst: maximum number of tokens saved up while idle
+    """
+
+    def __init__(self, path, host, rate=None, burst=1):
+        self.host = host
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._db = connect(path) if rate else None
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token, returns the seconds the caller has to wait before using it
+        """
+
+        if not self.rate:
+            return 0.0
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # time.time(), not monotonic: the clock is compared between processes
+                now = time.time()
+                row = self._db.execute("SELECT tokens, updated FROM rate_limits WHERE host = ?",
+                                       (self.host,)).fetchone()
+                tokens = float(self.capacity) if row is None else \
+                    min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+                tokens -= 1
+                self._db.execute("INSERT OR REPLACE INTO rate_limits (host, tokens, updated) VALUES (?, ?, ?)",
+                                 (self.host, tokens, now))
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+        return max(0.0, -tokens / self.rate)
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it may be used
+        """
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
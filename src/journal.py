@@ -0,0 +1,139 @@
+# Checkpoint journal used by main.py to resume an interrupted conversion
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import hashlib
+import json
+import os
+import threading
+
+
+class Journal:
+    """
+    Append-only record of finished stages, one JSON object per line
+    Stages are 'index', 'download', 'clean', 'cover' and 'epub'; 'download' and 'clean' are
+    recorded per chapter (item = chapter id, chapter names are not unique)
+
+    @type path: str
+    @param path: journal file, loaded if it already exists
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut short if the run was killed while writing it
+                        continue
+                    key = (record['volume'], record['stage'], record['item'])
+                    if record.get('undone'):
+                        self._done.pop(key, None)
+                    else:
+                        self._done[key] = record.get('data', {})
+            print("Journal: Loaded %d finished steps from %s" % (len(self._done), path))
+
+    def is_done(self, volume, stage, item=None):
+        """
+        Check if a stage has already been finished
+
+        @type volume: str
+        @param volume: volume name, '' for book-wide stages
+        @type stage: str
+        @param stage: stage name
+        @type item: str
+        @param item: chapter id for per-chapter stages, see catalog.Chapter
+        """
+
+        return (volume, stage, item) in self._done
+
+    def data(self, volume, stage, item=None):
+        """
+        Extra data stored with a finished stage
+        """
+
+        return self._done[(volume, stage, item)]
+
+    def mark(self, volume, stage, item=None, **data):
+        """
+        Record a finished stage, flushed to disk immediately
+
+        @type volume: str
+        @param volume: volume name, '' for book-wide stages
+        @type stage: str
+        @param stage: stage name
+        @type item: str
+        @param item: chapter id for per-chapter stages, see catalog.Chapter
+        """
+
+        self._append({'volume': volume, 'stage': stage, 'item': item, 'data': data})
+
+    def undo(self, volume, stage, item=None):
+        """
+        Forget a finished stage whose result is gone, e.g. a chapter file deleted with its temp folder
+
+        @type volume: str
+        @param volume: volume name, '' for book-wide stages
+        @type stage: str
+        @param stage: stage name
+        @type item: str
+        @param item: chapter id for per-chapter stages, see catalog.Chapter
+        """
+
+        if self.is_done(volume, stage, item):
+            self._append({'volume': volume, 'stage': stage, 'item': item, 'undone': True})
+
+    def _append(self, record):
+        # Flushed to disk immediately, the journal has to survive the process being killed
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        key = (record['volume'], record['stage'], record['item'])
+
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if record.get('undone'):
+                self._done.pop(key, None)
+            else:
+                self._done[key] = record['data']
+
+    def remove(self):
+        """
+        Delete the journal once the whole job has finished
+        """
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        print("Journal: Job finished, deleted %s" % self.path)
+
+
+def journal_key(index_url):
+    """
+    Short key naming the journal and the temp folder of a book
+
+    @type index_url: str
+    @param index_url: url to the index page
+    """
+
+    return hashlib.sha1(index_url.encode('utf-8')).hexdigest()[:16]
+
+
+def journal_path(index_url, directory="../journal"):
+    """
+    Journal file name for a book, one journal per index URL
+
+    @type index_url: str
+    @param index_url: url to the index page
+    @type directory: str
+    @param directory: folder holding the journals
+    """
+
+    return os.path.join(directory, journal_key(index_url) + '.jsonl')
@@ -5,10 +5,259 @@
 
 # Import Dependencies
 import functions
+import metrics
+import pipeline
+import worker
+from job_queue import JobQueue
+from catalog import Catalog, snapshot_path, load_snapshot, save_snapshot, diff_catalogs
+from journal import Journal, journal_key, journal_path
+import argparse
+import glob
+import json
 import os
+import sys
+
+# Number of chapters downloaded in parallel, also the number of browser sessions kept warm
+download_workers = 3
+# Maximum number of requests in flight to wenku8 at the same time
+max_requests_per_host = 3
+# Start browsers with eager page loading, a small window and a small disk cache, and choose per kind of page
+# whether images, stylesheets, fonts and media are blocked ('lean') or loaded ('full')
+lean_browser = True
+browser_profiles = {'index': 'lean', 'chapter': 'lean', 'illustrations': 'lean'}
+# Average requests per second sent to each host, None for no limit, and how many may go out back to back
+requests_per_second = 2
+request_burst = 4
+# Fetch chapters and illustrations over the asyncio engine (needs aiohttp) once the browser has solved the
+# Cloudflare challenge, keeping up to async_concurrency connections open
+use_async_fetch = False
+async_concurrency = 100
+# Bytes of chapters kept in memory between download, cleaning and packing, 0 writes every chapter to '../temp'
+chapter_memory_budget = 256 * 1024 * 1024
+# Number of processes packing finished volumes into epub files, 0 packs them in the main process
+pack_processes = os.cpu_count() or 1
+# Embed every image of the '插图' chapter, optionally downscaled so the longest side is at most this many pixels
+embed_illustrations = False
+illustration_max_size = 1600
+# Task queue shared by worker processes (--submit and --worker), requests_per_second then holds for all of them
+job_queue_file = "../store/jobs.sqlite3"
+
+
+def convert_book(index_url, volume_range=None, cover_policy=None, update=False):
+    """
+    Download and convert the chosen volumes of one book
+    In update mode the index is compared with the snapshot of the last run and only
+    new or changed volumes are rebuilt, unchanged chapters come from the cache
+
+    @type index_url: str
+    @param index_url: url to the index page of the book
+    @type volume_range: str
+    @param volume_range: volumes to convert, e.g. '2', '0-5' or 'all', None asks the user
+    @type cover_policy: str or int
+    @param cover_policy: 'first', an illustration index or an image URL, None asks the user
+    @type update: bool
+    @param update: only rebuild volumes that changed since the last run, all volumes by default
+    """
+
+    # Default location to save files, every book has its own temp folder
+    temp_root = '../temp/' + journal_key(index_url)
+    index_file = temp_root + '/index.html'  # File name
+
+    # Catalog of the volumes converted by the last successful run
+    snapshot_file = snapshot_path(index_url)
+    previous = load_snapshot(snapshot_file)
+
+    # Journal of finished steps, an interrupted run of the same book resumes from it
+    journal = Journal(journal_path(index_url))
+    resuming = journal.is_done('', 'index')
+
+    # Create temp directories, keep already downloaded chapters when resuming
+    functions.create_temp_dir(temp_root, keep_temp=resuming)
+
+    if resuming:
+        # Volume selection and chapter lists were saved by the interrupted run
+        print("main: Resuming interrupted job for %s ..." % index_url)
+        index_data = journal.data('', 'index')
+        catalog = Catalog.from_dict(index_data['catalog'])
+        rebuild = index_data['rebuild']
+        cached_chapters = set(index_data['cached_chapters'])
+    else:
+        # Download index page
+        # max_age=0: always ask the server whether the index changed
+        if functions.download_html(index_url, index_file, ready_selector=functions.INDEX_READY, max_age=0) is None:
+            raise RuntimeError("main: Failed to download index page %s" % index_url)
+
+        # Extract key information from the index.html file
+        if update and volume_range is None:
+            volume_range = 'all'
+        catalog = functions.extract_index(index_url, index_file, volume_range)
+
+        rebuild = None
+        cached_chapters = set()
+        if update:
+            rebuild, cached_chapters = diff_catalogs(previous, catalog)
+            print("main: %d of %d volumes are new or changed" % (len(rebuild), len(catalog.volumes)))
+
+        journal.mark('', 'index', catalog=catalog.to_dict(), rebuild=rebuild, cached_chapters=sorted(cached_chapters))
+
+    # Each volume gets its own temp folder, so the next volume can download while this one is packed
+    volumes = []
+    for volume in catalog.volumes:
+        if not volume.chapters:
+            print("main: '%s' has no chapters, skipping" % volume.name)
+            continue
+        if journal.is_done(volume.name, 'epub'):
+            print("main: '%s' already converted, skipping" % volume.name)
+            continue
+        if rebuild is not None and volume.name not in rebuild and os.path.exists('../epub/' + volume.name + '.epub'):
+            print("main: '%s' unchanged since the last run, skipping" % volume.name)
+            continue
+        volumes.append((volume, temp_root + '/volume_%d' % volume.order))
+
+    # Fetch, clean and pack the volumes as overlapping stages
+    pipeline.run_pipeline(volumes, catalog.author, workers=download_workers, journal=journal,
+                          cover_policy=cover_policy, pack_processes=pack_processes,
+                          cached_chapters=cached_chapters)
+
+    # Delete temp directories
+    functions.delete_temp_dir(temp_root)
+
+    # Remember what was converted, the next update run compares the index against it
+    save_snapshot(catalog, snapshot_file, previous)
+
+    # Every volume is packed, nothing left to resume
+    journal.remove()
+
+
+def rebuild_book(snapshot_file):
+    """
+    Re-pack every volume saved in a catalog snapshot from the on-disk cache, without network access
+    Covers chosen by the last run are reused, the first illustration is used if none was recorded
+
+    @type snapshot_file: str
+    @param snapshot_file: catalog snapshot written by a successful run, see catalog.snapshot_path
+    """
+
+    catalog = load_snapshot(snapshot_file)
+    if catalog is None:
+        raise RuntimeError("main: No snapshot %s, convert the book online first" % snapshot_file)
+
+    print("main: Rebuilding %d volumes of '%s' from the cache ..." % (len(catalog.volumes), catalog.title))
+
+    # Own temp folder, converting the same book at the same time keeps its files
+    temp_root = '../temp/rebuild-' + os.path.splitext(os.path.basename(snapshot_file))[0]
+    functions.create_temp_dir(temp_root)
+    volumes = [(volume, temp_root + '/volume_%d' % volume.order) for volume in catalog.volumes]
+    pipeline.run_pipeline(volumes, catalog.author, workers=download_workers, cover_policy='first',
+                          pack_processes=pack_processes)
+    functions.delete_temp_dir(temp_root)
+
+
+def run_rebuild(index_urls):
+    """
+    Rebuild the given books, or every book with a snapshot, from the on-disk cache
+
+    @type index_urls: list
+    @param index_urls: index page urls of the books, empty for every converted book
+    """
+
+    functions.configure_offline(True)
+
+    if index_urls:
+        snapshot_files = [snapshot_path(index_url) for index_url in index_urls]
+    else:
+        snapshot_files = sorted(glob.glob(os.path.join('../catalog', '*.json')))
+
+    failed = []
+    for snapshot_file in snapshot_files:
+        try:
+            rebuild_book(snapshot_file)
+        except Exception as e:
+            print("run_rebuild: Rebuild failed: %s" % e)
+            failed.append(snapshot_file)
+
+    print("run_rebuild: %d of %d books rebuilt" % (len(snapshot_files) - len(failed), len(snapshot_files)))
+    for snapshot_file in failed:
+        print("run_rebuild: Failed: %s" % snapshot_file)
+
+    return failed
+
+
+def run_batch(job_file):
+    """
+    Convert every book listed in a job file, one after another, without asking for input
+    The job file is a JSON list of objects such as
+    {"index_url": "https://www.wenku8.net/novel/1/1234/index.htm", "volumes": "0-5", "cover": "first"}
+    "volumes" defaults to "all", "cover" is "first", an illustration index or an image URL,
+    "update": true only rebuilds volumes that changed since the book was last converted
+
+    @type job_file: str
+    @param job_file: path to the JSON job file
+    """
+
+    with open(job_file, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+
+    failed = []
+    for i, job in enumerate(jobs):
+        print("run_batch: Job %d/%d: %s" % (i + 1, len(jobs), job['index_url']))
+        try:
+            convert_book(job['index_url'], job.get('volumes', 'all'), job.get('cover', 'first'),
+                         job.get('update', False))
+        except Exception as e:
+            # Keep going, the journal lets a later run resume this book
+            print("run_batch: Job failed: %s" % e)
+            failed.append(job['index_url'])
+
+    print("run_batch: %d of %d jobs finished" % (len(jobs) - len(failed), len(jobs)))
+    for index_url in failed:
+        print("run_batch: Failed: %s" % index_url)
+
+    return failed
+
+
+def run_submit(job_file, queue_file):
+    """
+    Queue every book of a job file (same format as for --batch) for worker processes
+
+    @type job_file: str
+    @param job_file: path to the JSON job file
+    @type queue_file: str
+    @param queue_file: job queue database
+    """
+
+    with open(job_file, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+
+    queue = JobQueue(queue_file)
+    try:
+        for job in jobs:
+            worker.submit_book(queue, job['index_url'], job.get('volumes', 'all'), job.get('cover', 'first'))
+    finally:
+        queue.close()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Convert light novels on wenku8.net to EPUB format")
+    parser.add_argument("--batch", metavar="JOB_FILE", help="convert every book listed in a JSON job file")
+    parser.add_argument("--update", action="store_true",
+                        help="only rebuild volumes that are new or changed since the book was last converted")
+    parser.add_argument("--rebuild", metavar="INDEX_URL", nargs="*",
+                        help="re-pack converted books from the download cache without network access, "
+                             "every converted book if no index URL is given")
+    parser.add_argument("--submit", metavar="JOB_FILE",
+                        help="queue every book of a JSON job file for --worker processes")
+    parser.add_argument("--worker", action="store_true",
+                        help="run queued fetch, clean and pack tasks until the queue is empty, "
+                             "start as many workers as needed")
+    parser.add_argument("--queue", metavar="QUEUE_FILE", help="job queue database, '%s' by default" % job_queue_file)
+    args = parser.parse_args()
+
+    # Resolve the job and queue files before changing directory
+    job_file = os.path.abspath(args.batch) if args.batch else None
+    submit_file = os.path.abspath(args.submit) if args.submit else None
+    queue_file = os.path.abspath(args.queue) if args.queue else None
+
     print("main: Starting wenku2epub programme ...")
 
     # Change to current working directory
@@ -24,39 +273,47 @@ def main():
     # Print the current working directory to confirm
     print(f"Current working directory is now: {os.getcwd()}")
 
-    # Ask user to enter the URL to the index page of the book
-    index_url = functions.get_index_url()
-
-    # Default location to save files
-    index_file = '../temp/index.html'  # File name
-    cover_file = '../temp/cover.jpg'
-
-    # Create temp directories
-    functions.create_temp_dir()
+    # Set up concurrent downloading, shared by every book of the run
+    # Processes working on the job queue draw from one rate limit kept in the queue database
+    queue_file = queue_file or job_queue_file
+    shared_buckets = worker.shared_rate_limit(queue_file, requests_per_second, request_burst) \
+        if submit_file or args.worker else None
+    functions.configure_browser_pool(size=download_workers, lean=lean_browser, profiles=browser_profiles)
+    functions.configure_fetch_control(max_requests_per_host, rate=requests_per_second, burst=request_burst,
+                                      bucket_factory=shared_buckets)
+    functions.configure_illustrations(embed_illustrations, max_size=illustration_max_size)
+    functions.configure_async_fetch(use_async_fetch, async_concurrency)
+    functions.configure_memory_path(chapter_memory_budget)
 
-    # Download index page
-    functions.download_html(index_url, index_file)
-
-    # Extract key information from the index.html file
-    title, author, volume_chapters = functions.extract_index(index_url, index_file)
-
-    # Loop through each volume
-    for i, (volume_name, chapter_list) in enumerate(volume_chapters.items()):
-
-        # Get book contents: chapters and cover image
-        chapter_list = functions.scrape_book(volume_name, chapter_list, cover_file)
-
-        # Create epub file
-        functions.create_epub(volume_name, author, chapter_list)
-
-        if i == len(volume_chapters) - 1:
-            # Delete temp directories
-            functions.delete_temp_dir()
+    # Books, snapshots or tasks that failed, listed by the run that reported them
+    failed = []
+    try:
+        if args.rebuild is not None:
+            failed = run_rebuild(args.rebuild)
+        elif submit_file or args.worker:
+            if submit_file:
+                run_submit(submit_file, queue_file)
+            if args.worker:
+                failed = worker.run_worker(queue_file, threads=download_workers)
+        elif job_file:
+            failed = run_batch(job_file)
         else:
-            # Remove and re-create temp directories
-            functions.create_temp_dir()
+            # Ask user to enter the URL to the index page of the book
+            index_url = functions.get_index_url()
+            convert_book(index_url, update=args.update)
+    finally:
+        # Quit the pooled browser sessions and trim the download cache
+        functions.close_browser_pool()
+        functions.close_chapter_store()
+        functions.evict_http_cache()
+
+        # Write per-page and per-stage timings to '../metrics'
+        metrics.export()
 
-    # Exit message
+    # Exit message, a non-zero exit code tells scripts and schedulers that something has to be retried
+    if failed:
+        print("main: %d failed, see the list above, exiting ..." % len(failed))
+        sys.exit(1)
     print("main: Successfully created and downloaded all epub files, exiting ...")
 
 
@@ -0,0 +1,158 @@
+# Per-page and per-stage timing records, exported as JSON lines and a Prometheus text file
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# Numeric fields summed per stage in the Prometheus export, with their metric names
+SUMMED_FIELDS = {
+    'wall_time': 'wenku2epub_stage_seconds_total',
+    'bytes': 'wenku2epub_bytes_total',
+    'retries': 'wenku2epub_retries_total',
+    'challenge_wait': 'wenku2epub_challenge_wait_seconds_total',
+    'parse_time': 'wenku2epub_parse_seconds_total',
+    'pack_time': 'wenku2epub_pack_seconds_total',
+}
+
+
+class Metrics:
+    """
+    Thread-safe list of events, one per page or stage run
+    Every event has 'stage', 'item', 'start' and 'wall_time' plus stage specific fields
+    such as bytes, retries, challenge_wait, parse_time or pack_time
+    """
+
+    def __init__(self):
+        self._events = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage, item):
+        """
+        Record the wall time of a with-block, the yielded dict takes extra fields
+
+        @type stage: str
+        @param stage: function or stage name, e.g. 'download_html'
+        @type item: str
+        @param item: url or file the stage worked on
+        """
+
+        event = {'stage': stage, 'item': item, 'start': time.time()}
+        start = time.perf_counter()
+        try:
+            yield event
+        except Exception:
+            event['ok'] = False
+            raise
+        finally:
+            event['wall_time'] = time.perf_counter() - start
+            event.setdefault('ok', True)
+            with self._lock:
+                self._events.append(event)
+
+    def drain(self):
+        """
+        Remove and return all events, used to send events of a worker process back to the main process
+        """
+
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def merge(self, events):
+        """
+        Add events recorded by another process
+
+        @type events: list
+        @param events: events returned by drain()
+        """
+
+        with self._lock:
+            self._events.extend(events)
+
+    def summary(self):
+        """
+        Totals per stage: number of events plus the sum of every field in SUMMED_FIELDS
+        """
+
+        totals = {}
+        with self._lock:
+            events = list(self._events)
+
+        for event in events:
+            stage = totals.setdefault(event['stage'], {'events': 0, 'failures': 0})
+            stage['events'] += 1
+            stage['failures'] += 0 if event.get('ok', True) else 1
+            for field in SUMMED_FIELDS:
+                if isinstance(event.get(field), (int, float)):
+                    stage[field] = stage.get(field, 0) + event[field]
+
+        return totals
+
+    def write_json(self, path):
+        """
+        Write every event as one JSON object per line
+
+        @type path: str
+        @param path: output file
+        """
+
+        with self._lock:
+            events = list(self._events)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, path):
+        """
+        Write the per-stage totals in the Prometheus text exposition format
+
+        @type path: str
+        @param path: output file, e.g. for the node_exporter textfile collector
+        """
+
+        totals = self.summary()
+        lines = ['# TYPE wenku2epub_stage_events_total counter',
+                 '# TYPE wenku2epub_stage_failures_total counter']
+        for stage, values in sorted(totals.items()):
+            lines.append('wenku2epub_stage_events_total{stage="%s"} %d' % (stage, values['events']))
+            lines.append('wenku2epub_stage_failures_total{stage="%s"} %d' % (stage, values['failures']))
+
+        for field, name in SUMMED_FIELDS.items():
+            lines.append('# TYPE %s counter' % name)
+            for stage, values in sorted(totals.items()):
+                if field in values:
+                    lines.append('%s{stage="%s"} %s' % (name, stage, repr(float(values[field]))))
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+# Events of the whole run, shared by functions.py and pipeline.py
+metrics = Metrics()
+
+
+def export(directory="../metrics"):
+    """
+    Write the events of this run to '<directory>/run-<time>.jsonl' and the totals to '<directory>/wenku2epub.prom'
+
+    @type directory: str
+    @param directory: output folder
+    """
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    metrics.write_json(os.path.join(directory, 'run-%s.jsonl' % stamp))
+    metrics.write_prometheus(os.path.join(directory, 'wenku2epub.prom'))
+
+    for stage, values in sorted(metrics.summary().items()):
+        print("metrics: %-16s %5d events  %8.2f s" % (stage, values['events'], values.get('wall_time', 0)))
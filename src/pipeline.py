@@ -0,0 +1,188 @@
+# Runs the fetch, clean and package stages of several volumes at the same time
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import functions
+from metrics import metrics
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import queue
+import shutil
+import threading
+
+
+def run_stage(name, func, inbox, outbox, errors, stop):
+    """
+    Take volumes from inbox, process them with func and pass the result to outbox
+    After an error in any stage the remaining volumes are drained without processing,
+    so no stage stays blocked on a full queue
+
+    @type name: str
+    @param name: stage name used in log messages
+    @type func: function
+    @param func: called with the items of each volume tuple, returns the tuple for the next stage
+    @type inbox: queue.Queue
+    @param inbox: volumes waiting for this stage, None marks the end
+    @type outbox: queue.Queue
+    @param outbox: volumes waiting for the next stage, None for the last stage
+    @type errors: list
+    @param errors: exceptions raised by any stage
+    @type stop: threading.Event
+    @param stop: set once a stage has failed
+    """
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        if stop.is_set():
+            continue
+
+        try:
+            with metrics.timer(name + '_volume', item[0]):
+                result = func(*item)
+        except Exception as e:
+            print("run_stage: %s stage failed for '%s': %s" % (name, item[0], e))
+            errors.append(e)
+            stop.set()
+            continue
+
+        if outbox is not None:
+            outbox.put(result)
+
+    if outbox is not None:
+        outbox.put(None)
+
+
+def pack_volume(title, author, chapter_list, cover_file, images):
+    """
+    Run create_epub in a worker process and hand its metrics back to the main process
+
+    @type title: str
+    @param title: volume/book title
+    @type author: str
+    @param author: author name
+    @type chapter_list: list
+    @param chapter_list: (chapter name, file location) pairs in reading order
+    @type cover_file: str
+    @param cover_file: file location of the cover image
+    @type images: list
+    @param images: embedded illustrations, see functions.illustration_files
+    """
+
+    functions.create_epub(title, author, chapter_list, cover_file, images)
+    return metrics.drain()
+
+
+def run_pipeline(volumes, author, workers=1, journal=None, queue_size=1, cover_policy=None, pack_processes=0,
+                 cached_chapters=None):
+    """
+    Fetch volume N+1 while volume N is cleaned and packed
+    Fetching runs in the calling thread because choosing a cover may ask for input,
+    every chapter is handed to a cleaning thread as soon as it has been downloaded
+
+    @type volumes: list
+    @param volumes: (catalog.Volume, temp folder of the volume) pairs
+    @type author: str
+    @param author: author name
+    @type workers: int
+    @param workers: number of chapters downloaded in parallel
+    @type journal: journal.Journal
+    @param journal: checkpoint journal, steps already recorded in it are skipped
+    @type queue_size: int
+    @param queue_size: number of finished volumes allowed to wait between two stages
+    @type cover_policy: str or int
+    @param cover_policy: how to pick the cover without asking, see functions.pick_cover
+    @type pack_processes: int
+    @param pack_processes: size of the process pool packing epub files, 0 packs in this process
+    @type cached_chapters: set
+    @param cached_chapters: ids of chapters unchanged since the last run, see functions.fetch_volume
+    """
+
+    clean_queue = queue.Queue(maxsize=queue_size)
+    pack_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+
+    # Chapters are cleaned while the rest of the volume is still downloading
+    clean_executor = ThreadPoolExecutor(max_workers=1)
+
+    def clean(volume_name, chapter_files, volume_dir, cleaning):
+        for future in cleaning:
+            future.result()
+        return volume_name, chapter_files, volume_dir
+
+    # Each volume is packed from its own temp folder into its own epub file, so workers never share files
+    # Workers are spawned rather than forked, forking while the stage threads hold locks can deadlock
+    pack_executor = None
+    if pack_processes and len(volumes) > 1:
+        pack_executor = ProcessPoolExecutor(max_workers=pack_processes,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def packed(volume_name, volume_dir):
+        if journal is not None:
+            journal.mark(volume_name, 'epub')
+        # Chapters of a packed volume are no longer needed
+        functions.release_chapters(volume_dir)
+        shutil.rmtree(volume_dir, ignore_errors=True)
+
+    def pack_done(future, volume_name, volume_dir):
+        try:
+            metrics.merge(future.result())
+        except Exception as e:
+            print("run_pipeline: Packing '%s' failed: %s" % (volume_name, e))
+            errors.append(e)
+            stop.set()
+            return
+        packed(volume_name, volume_dir)
+
+    def pack(volume_name, chapter_files, volume_dir):
+        # Chapters still in memory are handed over as bytes, also to the pack processes
+        chapter_list = [(chapter.title, functions.chapter_content(chapter_file))
+                        for chapter, chapter_file in chapter_files]
+        cover_file = volume_dir + '/cover.jpg'
+        images = functions.illustration_files(volume_dir)
+
+        if pack_executor is None:
+            functions.create_epub(volume_name, author, chapter_list, cover_file, images)
+            packed(volume_name, volume_dir)
+        else:
+            future = pack_executor.submit(pack_volume, volume_name, author, chapter_list, cover_file, images)
+            future.add_done_callback(lambda f: pack_done(f, volume_name, volume_dir))
+
+    stages = [
+        threading.Thread(target=run_stage, args=("clean", clean, clean_queue, pack_queue, errors, stop)),
+        threading.Thread(target=run_stage, args=("pack", pack, pack_queue, None, errors, stop)),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        for volume, volume_dir in volumes:
+            if stop.is_set():
+                break
+            cleaning = []
+
+            def on_chapter(chapter, chapter_file, volume_name=volume.name):
+                cleaning.append(clean_executor.submit(functions.clean_downloaded, volume_name, chapter,
+                                                      chapter_file, journal))
+
+            with metrics.timer('fetch_volume', volume.name):
+                chapter_files = functions.fetch_volume(volume, volume_dir + '/cover.jpg', workers, journal,
+                                                       volume_dir, cover_policy, cached_chapters, on_chapter)
+            clean_queue.put((volume.name, chapter_files, volume_dir, cleaning))
+    finally:
+        # Let the other stages finish the volumes already handed over
+        clean_queue.put(None)
+        for stage in stages:
+            stage.join()
+        clean_executor.shutdown(wait=True)
+        # Wait for the volumes still being packed by the process pool
+        if pack_executor is not None:
+            pack_executor.shutdown(wait=True)
+
+    if errors:
+        raise errors[0]
+
+    print("run_pipeline: Finished %d volumes" % len(volumes))
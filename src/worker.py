@@ -0,0 +1,269 @@
+# Distributed conversion: submit_book queues every chapter of a book as tasks in a shared job queue,
+# any number of worker processes, on one machine or several sharing the queue and store, run them
+# Version: 1
+# Date: 17/ 10/ 2026
+
+# Import dependencies
+import functions
+from catalog import Chapter, Volume
+from chapter_store import book_id
+from job_queue import JobQueue, SharedTokenBucket
+from metrics import metrics
+import os
+import shutil
+import socket
+import threading
+import time
+
+# Scratch folders of the worker threads, outside '../temp' which local conversions create and delete
+WORKER_DIR = '../store/workers'
+
+
+def shared_rate_limit(queue_path, rate, burst=1):
+    """
+    Bucket factory for functions.configure_fetch_control that makes every process using the same
+    queue share one rate limit per host
+
+    @type queue_path: str
+    @param queue_path: job queue database
+    @type rate: float
+    @param rate: requests per second allowed to each host over all processes, None for no limit
+    @type burst: int
+    @param burst: requests a host may receive back to back after being idle
+    """
+
+    return lambda host: SharedTokenBucket(queue_path, host, rate, burst)
+
+
+def volume_group(book, volume_name):
+    return book + '/' + volume_name
+
+
+def submit_book(queue, index_url, volume_range='all', cover_policy='first'):
+    """
+    Download the index of a book and queue a fetch task per chapter and a pack task per volume
+    Chapters already queued are not queued again, failed ones are retried
+
+    @type queue: job_queue.JobQueue
+    @param queue: shared job queue
+    @type index_url: str
+    @param index_url: url to the index page of the book
+    @type volume_range: str
+    @param volume_range: volumes to convert, e.g. '2', '0-5' or 'all'
+    @type cover_policy: str or int
+    @param cover_policy: 'first', an illustration index or an image URL, see functions.pick_cover
+    """
+
+    # Own file name, other processes may be submitting at the same time
+    os.makedirs(WORKER_DIR, exist_ok=True)
+    index_file = '%s/index-%d.html' % (WORKER_DIR, os.getpid())
+    if functions.download_html(index_url, index_file, ready_selector=functions.INDEX_READY, max_age=0) is None:
+        raise RuntimeError("submit_book: Failed to download index page %s" % index_url)
+    catalog = functions.extract_index(index_url, index_file, volume_range)
+    os.remove(index_file)
+
+    tasks = []
+    for volume in catalog.volumes:
+        if not volume.chapters:
+            continue
+        book = book_id(volume.chapters[0].url)
+        group = volume_group(book, volume.name)
+        for chapter in volume.chapters:
+            tasks.append(('fetch', 'fetch:%s:%s' % (group, chapter.chapter_id),
+                          {'book': book, 'volume': volume.name, 'chapter': chapter.to_dict()}, group, None))
+        # Packed once every chapter of the volume is fetched and cleaned
+        tasks.append(('pack', 'pack:' + group, {'book': book, 'author': catalog.author, 'volume': volume.to_dict(),
+                                                'cover_policy': cover_policy}, None, group))
+
+    queue.put(tasks)
+    print("submit_book: Queued %d volumes of '%s'" % (len(catalog.volumes), catalog.title))
+
+
+def fetch_task(payload, temp_dir):
+    """
+    Download one chapter into the chapter store, returns the clean task that follows it
+
+    @type payload: dict
+    @param payload: 'book', 'volume' and 'chapter' of the task
+    @type temp_dir: str
+    @param temp_dir: private folder of the worker thread
+    """
+
+    chapter = Chapter.from_dict(payload['chapter'])
+    page = functions.fetch_page(chapter.url, page_type='illustrations' if chapter.title == '插图' else 'chapter')
+    if page is None:
+        raise RuntimeError("fetch_task: Failed to download chapter '%s'" % chapter.title)
+    functions.chapter_store.put_raw(payload['book'], payload['volume'], chapter, page)
+
+    # The '插图' page is not cleaned, pack_task reads the image links from the raw page
+    if chapter.title == '插图':
+        return []
+    group = volume_group(payload['book'], payload['volume'])
+    return [('clean', 'clean:%s:%s' % (group, chapter.chapter_id), payload, group, None)]
+
+
+def clean_task(payload, temp_dir):
+    """
+    Clean one stored chapter and store the result
+
+    @type payload: dict
+    @param payload: 'book', 'volume' and 'chapter' of the task
+    @type temp_dir: str
+    @param temp_dir: private folder of the worker thread
+    """
+
+    chapter = Chapter.from_dict(payload['chapter'])
+    raw = functions.chapter_store.raw(payload['book'], payload['volume'], chapter.chapter_id)
+    if raw is None:
+        raise RuntimeError("clean_task: Chapter '%s' is not in the chapter store" % chapter.title)
+
+    chapter_file = temp_dir + '/' + chapter.chapter_id + '.html'
+    functions.write_chapter(chapter_file, raw)
+    try:
+        functions.clean_downloaded(payload['volume'], chapter, chapter_file)
+    finally:
+        functions.remove_chapter(chapter_file)
+    return []
+
+
+def pack_task(payload, temp_dir):
+    """
+    Build the epub of a volume from the cleaned chapters in the chapter store
+
+    @type payload: dict
+    @param payload: 'book', 'author', 'volume' and 'cover_policy' of the task
+    @type temp_dir: str
+    @param temp_dir: private folder of the worker thread
+    """
+
+    book = payload['book']
+    volume = Volume.from_dict(payload['volume'])
+    stored = functions.chapter_store.volume_chapters(book, volume.name, functions.CLEANER_VERSION)
+
+    chapter_list = []
+    image_pages = []
+    for chapter in volume.chapters:
+        entry = stored.get(chapter.chapter_id)
+        if chapter.title == '插图':
+            image_pages.append(entry)
+            continue
+        if entry is None or entry['cleaned'] is None:
+            raise RuntimeError("pack_task: Chapter '%s' is not cleaned" % chapter.title)
+        # Same bytes clean_chapter writes to a chapter file
+        chapter_list.append((chapter.title, entry['cleaned'].encode('utf-8-sig')))
+
+    cover_url = volume.cover_url
+    if cover_url is None:
+        image_url = []
+        if image_pages and image_pages[0] is not None and image_pages[0]['raw'] is not None:
+            image_page = temp_dir + '/image_page.html'
+            functions.write_chapter(image_page, image_pages[0]['raw'])
+            image_url = functions.extract_images(image_page)
+        cover_url = functions.pick_cover(image_url, payload['cover_policy'] or 'first',
+                                           functions.index_cover_url(volume.chapters[0].url))
+
+    cover_file = temp_dir + '/cover.jpg'
+    if functions.download_image(cover_url, cover_file) is None:
+        raise RuntimeError("pack_task: Failed to download cover image")
+    try:
+        functions.create_epub(volume.name, payload['author'], chapter_list, cover_file)
+    finally:
+        os.remove(cover_file)
+    return []
+
+
+TASK_HANDLERS = {'fetch': fetch_task, 'clean': clean_task, 'pack': pack_task}
+
+
+def keep_lease(queue, task_id, worker, lease, finished):
+    # Renew the lease well before it runs out while the task is running
+    while not finished.wait(lease / 3):
+        if not queue.heartbeat(task_id, worker, lease):
+            print("run_worker: %s lost the lease of task %d" % (worker, task_id))
+            return
+
+
+def work(queue, worker, temp_dir, lease, poll):
+    """
+    Run tasks until no task is pending or leased anywhere
+
+    @type queue: job_queue.JobQueue
+    @param queue: shared job queue
+    @type worker: str
+    @param worker: unique name of this worker thread
+    @type temp_dir: str
+    @param temp_dir: private folder of this worker thread
+    @type lease: float
+    @param lease: seconds a claimed task belongs to this worker without a heartbeat
+    @type poll: float
+    @param poll: seconds to wait when every runnable task is taken
+    """
+
+    while True:
+        task = queue.claim(worker, lease)
+        if task is None:
+            counts = queue.counts()
+            # Leased tasks may still add follow-ups or be given back, pending ones may wait for a retry delay
+            if not counts.get('pending') and not counts.get('leased'):
+                return
+            time.sleep(poll)
+            continue
+
+        task_id, kind, payload, attempt = task
+        # Created for every task, nothing the folder held before is needed
+        os.makedirs(temp_dir, exist_ok=True)
+        finished = threading.Event()
+        keeper = threading.Thread(target=keep_lease, args=(queue, task_id, worker, lease, finished), daemon=True)
+        keeper.start()
+        try:
+            with metrics.timer(kind + '_task', task_id):
+                follow_ups = TASK_HANDLERS[kind](payload, temp_dir)
+        except Exception as e:
+            print("run_worker: %s task %d failed (attempt %d): %s" % (kind, task_id, attempt, e))
+            queue.fail(task_id, worker, str(e), functions.fetch_control.backoff(attempt - 1))
+        else:
+            if not queue.complete(task_id, worker, follow_ups):
+                print("run_worker: Task %d was taken over by another worker, result dropped" % task_id)
+        finally:
+            finished.set()
+            keeper.join()
+
+
+def run_worker(queue_path, threads=1, lease=120, poll=1.0):
+    """
+    Take fetch, clean and pack tasks from the shared queue until every queued task is done or failed
+    Any number of workers can run at once, tasks of a worker that dies are retried once their lease runs out
+    Returns (kind, key, error) of every failed task
+
+    @type queue_path: str
+    @param queue_path: job queue database shared by every worker
+    @type threads: int
+    @param threads: tasks this process runs at the same time
+    @type lease: float
+    @param lease: seconds a claimed task belongs to its worker without a heartbeat
+    @type poll: float
+    @param poll: seconds to wait when every runnable task is taken
+    """
+
+    queue = JobQueue(queue_path)
+    name = '%s-%d' % (socket.gethostname(), os.getpid())
+    print("run_worker: Worker %s started with %d threads" % (name, threads))
+
+    workers = [threading.Thread(target=work, args=(queue, '%s-%d' % (name, i), '%s/%s-%d' % (WORKER_DIR, name, i),
+                                                   lease, poll))
+               for i in range(threads)]
+    try:
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    finally:
+        for i in range(threads):
+            shutil.rmtree('%s/%s-%d' % (WORKER_DIR, name, i), ignore_errors=True)
+
+    failed = queue.failures()
+    queue.close()
+    print("run_worker: Queue finished, %d tasks failed" % len(failed))
+    for kind, key, error in failed:
+        print("run_worker: Failed %s: %s" % (key, error))
+    return failed